@@ -1,31 +1,483 @@
-import requests
+import asyncio
+import contextlib
 import json
-from config import API_KEY
+import random
+import time
+import httpx
+from collections import deque
+from metrics import stage, stats_gauge, register, Gauge, LLM_REQUESTS, STAGE_SECONDS
+from config import (AI_BACKENDS, AI_ROUTES, API_TIMEOUT, API_TOTAL_TIMEOUT, API_MAX_RETRIES,
+                    API_RETRY_BASE_DELAY, API_RETRY_MAX_DELAY, AI_HEDGE, AI_HEDGE_QUANTILE,
+                    AI_HEDGE_DEFAULT_DELAY, AI_HEDGE_MIN_DELAY, AI_HEDGE_MAX_DELAY, AI_LATENCY_WINDOW,
+                    AI_BREAKER_FAILURES, AI_BREAKER_COOLDOWN)
 
-def call_ai(messages, model="openai/gpt-3.5-turbo"):
-    """Вызов API ИИ"""
-    try:
-        response = requests.post(
-            url="https://openrouter.ai/api/v1/chat/completions",
-            headers={
-                "Authorization": f"Bearer {API_KEY}",
-                "Content-Type": "application/json"
-            },
-            data=json.dumps({
-                "model": model,
-                "messages": messages
-            }),
-            timeout=30
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+# Статусы, при которых имеет смысл повторить запрос
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+class AIError(Exception):
+    """Ошибка вызова API ИИ"""
+
+class AITimeoutError(AIError):
+    """Истекло время ожидания ответа"""
+
+class AIConnectionError(AIError):
+    """Не удалось соединиться с API"""
+
+class AIStatusError(AIError):
+    """API вернул ошибочный HTTP статус"""
+    def __init__(self, status_code, text):
+        super().__init__(f"Ошибка API: {status_code} - {text}")
+        self.status_code = status_code
+        self.text = text
+
+class AIResponseError(AIError):
+    """API вернул ответ неверного формата"""
+
+class AIUnavailableError(AIError):
+    """Сервер ИИ отключен размыкателем или его очередь переполнена"""
+
+def is_outage(error):
+    """Говорит ли ошибка о недоступности сервера (а не о неверном запросе)"""
+    if isinstance(error, AIStatusError):
+        return error.status_code in RETRY_STATUSES
+    return isinstance(error, (AITimeoutError, AIConnectionError))
+
+_client = None
+
+# Учет токенов: сколько отправлено и сколько провайдер взял из кэша префиксов
+usage_stats = {
+    "requests": 0,
+    "prompt_tokens": 0,
+    "completion_tokens": 0,
+    "cached_tokens": 0,
+    "cache_hits": 0
+}
+stats_gauge("lifesim_llm_usage", "Ответы ИИ и токены: prompt, completion, cached", usage_stats, "kind")
+
+class CircuitBreaker:
+    """Размыкатель: после failures ошибок недоступности подряд сервер пропускается
+    cooldown секунд, затем к нему уходит один пробный запрос. Удачный пробный
+    запрос замыкает цепь, неудачный - снова размыкает ее"""
+
+    def __init__(self, failures=3, cooldown=30):
+        self.max_failures = failures
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if self.probing or time.monotonic() - self.opened_at >= self.cooldown:
+            return "half_open"
+        return "open"
+
+    def available(self):
+        """Можно ли сейчас отправить запрос (без изменения состояния)"""
+        state = self.state
+        return state == "closed" or (state == "half_open" and not self.probing)
+
+    def allow(self):
+        """Разрешает запрос; в полуоткрытом состоянии - только один пробный"""
+        if not self.available():
+            return False
+        if self.opened_at is not None:
+            self.probing = True
+        return True
+
+    def success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def failure(self):
+        self.failures += 1
+        if self.probing or self.failures >= self.max_failures:
+            self.opened_at = time.monotonic()
+        self.probing = False
+
+    def release(self):
+        """Запрос отменен, исход неизвестен: пробный запрос можно повторить"""
+        self.probing = False
+
+class OpenAIBackend:
+    """Сервер с OpenAI-совместимым /chat/completions: llama.cpp, vLLM, Ollama и т.п.
+
+    У каждого сервера свой лимит одновременных запросов и своя очередь ожидания:
+    если очередь длиннее max_queue, запрос сразу уходит другому серверу маршрута"""
+
+    def __init__(self, name, url, api_key="", max_concurrent=8, max_queue=64):
+        self.name = name
+        self.url = url
+        self.api_key = api_key
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.breaker = CircuitBreaker(AI_BREAKER_FAILURES, AI_BREAKER_COOLDOWN)
+        self.waiting = 0
+        self.active = 0
+        self._semaphore = None
+
+    @property
+    def semaphore(self):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrent)
+        return self._semaphore
+
+    def headers(self):
+        headers = {"Content-Type": "application/json"}
+        if self.api_key:
+            headers["Authorization"] = f"Bearer {self.api_key}"
+        return headers
+
+    def payload(self, model, messages, stream=False):
+        body = {"model": model, "messages": messages}
+        if stream:
+            body["stream"] = True
+            body["stream_options"] = {"include_usage": True}
+        return body
+
+    def busy(self):
+        """Все места заняты - дублировать на этот сервер медленный запрос незачем"""
+        return self.active >= self.max_concurrent
+
+    @contextlib.asynccontextmanager
+    async def slot(self):
+        """Место для запроса: проверка размыкателя, очередь и лимит одновременных запросов.
+        Исход запроса внутри блока учитывается размыкателем"""
+        if not self.breaker.allow():
+            raise AIUnavailableError(f"Сервер ИИ {self.name} временно отключен")
+        if self.waiting >= self.max_queue:
+            self.breaker.release()
+            raise AIUnavailableError(f"Очередь сервера ИИ {self.name} переполнена")
+        self.waiting += 1
+        try:
+            await self.semaphore.acquire()
+        except BaseException:
+            self.breaker.release()
+            raise
+        finally:
+            self.waiting -= 1
+
+        self.active += 1
+        try:
+            yield
+        except AIError as e:
+            if is_outage(e):
+                self.breaker.failure()
+            else:
+                self.breaker.success()
+            raise
+        except BaseException:
+            self.breaker.release()
+            raise
+        else:
+            self.breaker.success()
+        finally:
+            self.active -= 1
+            self.semaphore.release()
+
+class OpenRouterBackend(OpenAIBackend):
+    """OpenRouter: OpenAI-совместимый API и учет токенов в поле usage"""
+
+    def payload(self, model, messages, stream=False):
+        body = super().payload(model, messages, stream)
+        body["usage"] = {"include": True}
+        return body
+
+BACKEND_TYPES = {"openrouter": OpenRouterBackend, "openai": OpenAIBackend}
+
+def create_backend(name, options):
+    """Создает сервер ИИ по описанию из AI_BACKENDS"""
+    options = dict(options)
+    backend_type = options.pop("type", "openai")
+    if backend_type not in BACKEND_TYPES:
+        raise ValueError(f"Неизвестный тип сервера ИИ {name}: {backend_type}")
+    return BACKEND_TYPES[backend_type](name, **options)
+
+backends = {name: create_backend(name, options) for name, options in AI_BACKENDS.items()}
+
+def resolve_target(entry):
+    """Запись маршрута "сервер:модель" (или просто "модель" - на первом сервере) -> (сервер, модель)"""
+    name, _, model = entry.partition(":")
+    if model and name in backends:
+        return backends[name], model
+    return next(iter(backends.values())), entry
+
+routes = {kind: [resolve_target(entry) for entry in entries] for kind, entries in AI_ROUTES.items()}
+
+BREAKER_STATES = {"closed": 0, "half_open": 1, "open": 2}
+register(Gauge("lifesim_llm_backend_state", "Состояние размыкателя сервера ИИ: 0 - работает, 1 - проба, 2 - отключен",
+               lambda: [({"backend": b.name}, BREAKER_STATES[b.breaker.state]) for b in backends.values()]))
+register(Gauge("lifesim_llm_backend_queue", "Запросы к серверу ИИ: выполняются и ждут места",
+               lambda: [({"backend": b.name, "state": state}, value) for b in backends.values()
+                        for state, value in (("active", b.active), ("waiting", b.waiting))]))
+
+class LatencyTracker:
+    """Задержки последних ответов каждой модели (скользящее окно) и их квантили"""
+
+    def __init__(self, window=200, min_samples=20):
+        self.window = window
+        self.min_samples = min_samples
+        self._samples = {}  # модель -> deque задержек
+
+    def observe(self, model, seconds):
+        samples = self._samples.get(model)
+        if samples is None:
+            samples = self._samples[model] = deque(maxlen=self.window)
+        samples.append(seconds)
+
+    def quantile(self, model, q):
+        """Квантиль задержки модели (None, пока замеров меньше min_samples)"""
+        samples = self._samples.get(model)
+        if samples is None or len(samples) < self.min_samples:
+            return None
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def models(self):
+        return list(self._samples)
+
+latency = LatencyTracker(AI_LATENCY_WINDOW)
+
+# Хеджирование: сколько запросов продублировано запасной модели и чьи ответы взяты
+hedge_stats = {"hedged": 0, "failover": 0, "primary_wins": 0, "alternate_wins": 0, "invalid": 0}
+stats_gauge("lifesim_llm_hedge", "Хеджирование запросов к ИИ: дубли, переключения, чей ответ взят", hedge_stats, "kind")
+
+def target_name(target):
+    backend, model = target
+    return f"{backend.name}:{model}"
+
+def hedge_delay(model):
+    """Через сколько секунд дублировать запрос к модели: p95 ее недавних ответов в пределах границ"""
+    estimate = latency.quantile(model, AI_HEDGE_QUANTILE)
+    if estimate is None:
+        return AI_HEDGE_DEFAULT_DELAY
+    return min(AI_HEDGE_MAX_DELAY, max(AI_HEDGE_MIN_DELAY, estimate))
+
+register(Gauge("lifesim_llm_hedge_delay_seconds", "Текущая задержка хеджирования по моделям",
+               lambda: [({"model": model}, hedge_delay(model)) for model in latency.models()]))
+
+def route(kind):
+    """Серверы и модели для вида вызова: основная и запасные, без отключенных размыкателем.
+    Если отключены все, возвращается весь маршрут - запросы получат AIUnavailableError"""
+    targets = routes.get(kind) or routes["narration"]
+    return [target for target in targets if target[0].breaker.available()] or targets
+
+def get_client():
+    """Возвращает общий HTTP клиент с keep-alive соединениями"""
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            http2=HTTP2_AVAILABLE,
+            limits=httpx.Limits(max_connections=sum(b.max_concurrent for b in backends.values()) * 2,
+                                keepalive_expiry=60)
         )
-        
-        if response.status_code == 200:
-            try:
-                result = response.json()
-                return result['choices'][0]['message']['content']
-            except json.JSONDecodeError:
-                return "Ошибка: неверный ответ от API"
+    return _client
+
+async def close_client():
+    """Закрывает HTTP клиент"""
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+def retry_delay(attempt, response=None):
+    """Экспоненциальная задержка со случайным разбросом"""
+    delay = random.uniform(0, min(API_RETRY_MAX_DELAY, API_RETRY_BASE_DELAY * 2 ** attempt))
+    if response is not None:
+        try:
+            delay = max(delay, float(response.headers.get("Retry-After", 0)))
+        except ValueError:
+            pass
+    return delay
+
+def record_usage(usage):
+    """Обновляет счетчики токенов по полю usage ответа"""
+    usage_stats["requests"] += 1
+    if not usage:
+        return
+    usage_stats["prompt_tokens"] += usage.get("prompt_tokens") or 0
+    usage_stats["completion_tokens"] += usage.get("completion_tokens") or 0
+    cached = (usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0
+    usage_stats["cached_tokens"] += cached
+    if cached:
+        usage_stats["cache_hits"] += 1
+
+def extract_content(response):
+    """Достает текст ответа из JSON"""
+    try:
+        result = response.json()
+        content = result['choices'][0]['message']['content']
+    except (ValueError, KeyError, IndexError, TypeError):
+        raise AIResponseError("Ошибка: неверный ответ от API")
+    record_usage(result.get("usage"))
+    return content
+
+async def call_model(messages, target):
+    """Вызов одной модели на своем сервере с повторами. Задержка учитывается без
+    ожидания места в очереди, чтобы очередь внутри бота не выглядела как медленная модель"""
+    backend, model = target
+    name = target_name(target)
+    async with backend.slot():
+        started = time.monotonic()
+        try:
+            with stage("llm"):
+                content = await post_with_retries(backend, messages, model)
+        except asyncio.CancelledError:
+            # Отмененный проигравший: время до отмены - нижняя оценка его задержки,
+            # без нее медленный хвост модели выпадал бы из статистики
+            latency.observe(name, time.monotonic() - started)
+            raise
+        latency.observe(name, time.monotonic() - started)
+        return content
+
+async def call_ai(messages, kind="narration", validate=None):
+    """Вызов API ИИ моделью для вида вызова kind ("narration", "parse", "summary").
+
+    Если основная модель не ответила за hedge_delay, тот же запрос уходит запасной
+    модели; ошибка или непригодный ответ (validate вернул False) переключает на
+    запасную сразу. Берется первый пригодный ответ, остальные запросы отменяются.
+    Если пригодных ответов нет, возвращается первый полученный"""
+    primary, *alternates = route(kind)
+    pending = {asyncio.ensure_future(call_model(messages, primary))}
+    primary_task = next(iter(pending))
+    error = None
+    fallback = None
+    try:
+        while pending:
+            timeout = hedge_delay(target_name(primary)) if alternates and AI_HEDGE else None
+            done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                try:
+                    content = task.result()
+                except AIError as e:
+                    error = error or e
+                    continue
+                if validate is None or validate(content):
+                    hedge_stats["primary_wins" if task is primary_task else "alternate_wins"] += 1
+                    return content
+                hedge_stats["invalid"] += 1
+                if fallback is None:
+                    fallback = content
+
+            if alternates and (done or not alternates[0][0].busy()):
+                # Ответа нет дольше обычного (а у запасного сервера есть места) или он не годится
+                hedge_stats["failover" if done else "hedged"] += 1
+                pending.add(asyncio.ensure_future(call_model(messages, alternates.pop(0))))
+        if fallback is not None:
+            return fallback
+        raise error
+    finally:
+        for task in pending:
+            task.cancel()
+
+async def post_with_retries(backend, messages, model):
+    """Запрос к серверу с повторами при 429/5xx и ошибках соединения"""
+    deadline = time.monotonic() + API_TOTAL_TIMEOUT
+    attempt = 0
+
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise AITimeoutError("Ошибка: превышено время ожидания ответа от API")
+
+        response = None
+        try:
+            response = await get_client().post(
+                backend.url,
+                json=backend.payload(model, messages),
+                headers=backend.headers(),
+                timeout=min(API_TIMEOUT, remaining)
+            )
+        except httpx.TimeoutException:
+            LLM_REQUESTS.inc(status="timeout", backend=backend.name)
+            error = AITimeoutError("Ошибка: превышено время ожидания ответа от API")
+        except httpx.TransportError as e:
+            LLM_REQUESTS.inc(status="connection", backend=backend.name)
+            error = AIConnectionError(f"Ошибка соединения: {e}")
         else:
-            return f"Ошибка API: {response.status_code} - {response.text}"
-            
-    except Exception as e:
-        return f"Ошибка соединения: {str(e)}"
+            LLM_REQUESTS.inc(status=str(response.status_code), backend=backend.name)
+            if response.status_code == 200:
+                return extract_content(response)
+            error = AIStatusError(response.status_code, response.text)
+            if response.status_code not in RETRY_STATUSES:
+                raise error
+
+        attempt += 1
+        delay = retry_delay(attempt, response)
+        if attempt > API_MAX_RETRIES or time.monotonic() + delay >= deadline:
+            raise error
+        await asyncio.sleep(delay)
+
+async def stream_ai(messages, kind="narration"):
+    """Потоковый вызов API ИИ: отдает текст ответа по частям (SSE).
+    Повторные попытки возможны только до получения первой части.
+    Поток не хеджируется: части ответа сразу показываются игроку"""
+    backend, model = route(kind)[0]
+    deadline = time.monotonic() + API_TOTAL_TIMEOUT
+    attempt = 0
+    started = False
+
+    async with backend.slot():
+        started_at = time.perf_counter()
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise AITimeoutError("Ошибка: превышено время ожидания ответа от API")
+
+            response = None
+            try:
+                async with get_client().stream(
+                    "POST", backend.url,
+                    json=backend.payload(model, messages, stream=True),
+                    headers=backend.headers(),
+                    timeout=min(API_TIMEOUT, remaining)
+                ) as response:
+                    LLM_REQUESTS.inc(status=str(response.status_code), backend=backend.name)
+                    if response.status_code == 200:
+                        async for line in response.aiter_lines():
+                            if not line.startswith("data:"):
+                                continue
+                            data = line[5:].strip()
+                            if data == "[DONE]":
+                                break
+                            try:
+                                chunk = json.loads(data)
+                            except ValueError:
+                                raise AIResponseError("Ошибка: неверный ответ от API")
+                            if chunk.get("usage"):
+                                record_usage(chunk["usage"])
+                            for choice in chunk.get("choices", []):
+                                text = (choice.get("delta") or {}).get("content")
+                                if text:
+                                    started = True
+                                    yield text
+                        STAGE_SECONDS.observe(time.perf_counter() - started_at, stage="llm")
+                        return
+                    await response.aread()
+                    error = AIStatusError(response.status_code, response.text)
+                    if response.status_code not in RETRY_STATUSES:
+                        raise error
+            except httpx.TimeoutException:
+                LLM_REQUESTS.inc(status="timeout", backend=backend.name)
+                error = AITimeoutError("Ошибка: превышено время ожидания ответа от API")
+            except httpx.TransportError as e:
+                LLM_REQUESTS.inc(status="connection", backend=backend.name)
+                error = AIConnectionError(f"Ошибка соединения: {e}")
+
+            # Часть ответа уже показана игроку - повторять нельзя
+            if started:
+                raise error
+            attempt += 1
+            delay = retry_delay(attempt, response)
+            if attempt > API_MAX_RETRIES or time.monotonic() + delay >= deadline:
+                raise error
+            await asyncio.sleep(delay)
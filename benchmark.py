@@ -0,0 +1,841 @@
+"""Нагрузочный тест бота без Telegram и OpenRouter.
+
+Обработчики из main.py вызываются напрямую с поддельными Update/Bot, а вместо
+OpenRouter поднимается локальный сервер chat completions с настраиваемой
+задержкой и долей ошибок. Все данные игроков пишутся во временную папку.
+
+    python benchmark.py --players 2000 --ops 5
+    python benchmark.py --save-baseline      # сохранить результат как эталон
+    python benchmark.py --records 20000      # только сравнение форматов записи игрока
+    python benchmark.py --scan 20000         # задержка команд во время просмотра всего хранилища
+    python benchmark.py --intents            # точность и скорость распознавания намерений
+    python benchmark.py --conservation 3000  # сохранение денег и предметов при одновременных передачах
+    python benchmark.py --transfer-parse     # точность и скорость локального разбора команд передачи
+"""
+import os
+import sys
+import json
+import time
+import types
+import random
+import shutil
+import asyncio
+import argparse
+import tempfile
+import threading
+import tracemalloc
+from collections import defaultdict, deque
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_baseline.json")
+PROMPT_SOURCE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "prompt.txt")
+INTENT_CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "intent_corpus.tsv")
+TRANSFER_CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "transfer_corpus.tsv")
+
+# --scan: p99 команд во время просмотра в потоке не выше idle.p99 * множитель + запас (секунд).
+# Просмотр прямо в цикле событий дает p99 в сотни раз выше простоя
+SCAN_P99_FACTOR = 5
+SCAN_P99_SLACK = 0.02
+
+# Инвентарь отправителя для команд из transfer_corpus.tsv
+TRANSFER_CORPUS_INVENTORY = {
+    "яблоко": 10, "меч": 1, "хлеб": 3, "вода": 2, "ноутбук": 1, "ключи": 1, "сигареты": 5, "кофе": 4,
+    "телефон": 1, "штаны": 1, "велосипед": 1, "кольцо": 1, "золотое кольцо": 1, "цветы": 3, "машина": 1,
+}
+
+# ---------- Локальный сервер chat completions ----------
+
+class MockLLMServer:
+    """Сервер, отвечающий как /chat/completions с логнормальной задержкой.
+    У моделей из slow_models доля tail_share ответов задерживается до tail_latency.
+    В доле item_share ответов игрок получает или теряет один предмет"""
+
+    def __init__(self, latency, sigma, failure_rate, seed=0, slow_models=(), tail_share=0, tail_latency=0,
+                 item_share=0):
+        self.latency = latency
+        self.sigma = sigma
+        self.failure_rate = failure_rate
+        self.slow_models = set(slow_models)
+        self.tail_share = tail_share
+        self.tail_latency = tail_latency
+        self.item_share = item_share
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.failures = 0
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, "127.0.0.1", 0)
+        port = self.server.sockets[0].getsockname()[1]
+        return f"http://127.0.0.1:{port}/api/v1/chat/completions"
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    def completion(self, body):
+        messages = body.get("messages", [])
+        system = messages[0]["content"] if messages else ""
+        last = messages[-1]["content"] if messages else ""
+        if "парсер команд передачи" in system:
+            return "<money=0>\n<items=>\n<receiver_id=>\n<message=>"
+        if "краткую память" in system:
+            return "Игрок работает и копит деньги."
+        balance = 1000
+        marker = "Баланс: "
+        if marker in last:
+            balance = int(last.split(marker, 1)[1].split("$", 1)[0])
+        new_balance = max(0, balance + self.random.randint(-50, 100))
+        items = ""
+        if self.random.random() < self.item_share:
+            items = f"\n<inventory:предмет {self.random.randrange(10)}={self.random.choice(('+1', '-1'))}>"
+        return (f"<thinking>Считаю баланс</thinking>\n<response>Вы поработали и получили результат.</response>\n"
+                f"<balance={new_balance}>{items}")
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                length = 0
+                for line in head.decode("latin-1").split("\r\n"):
+                    if line.lower().startswith("content-length:"):
+                        length = int(line.split(":", 1)[1])
+                body = json.loads(await reader.readexactly(length)) if length else {}
+                self.requests += 1
+
+                delay = self.random.lognormvariate(0, self.sigma) * self.latency
+                if body.get("model") in self.slow_models and self.random.random() < self.tail_share:
+                    delay = self.tail_latency
+                await asyncio.sleep(delay)
+                if self.random.random() < self.failure_rate:
+                    self.failures += 1
+                    status, payload, content_type = "503 Service Unavailable", b'{"error": "overloaded"}', "application/json"
+                else:
+                    content = self.completion(body)
+                    usage = {"prompt_tokens": 1500, "completion_tokens": 60}
+                    if body.get("stream"):
+                        chunks = [content[i:i + 20] for i in range(0, len(content), 20)]
+                        payload = "".join(
+                            f"data: {json.dumps({'choices': [{'delta': {'content': c}}]}, ensure_ascii=False)}\n\n"
+                            for c in chunks
+                        ) + f"data: {json.dumps({'choices': [], 'usage': usage})}\n\ndata: [DONE]\n\n"
+                        payload, content_type = payload.encode(), "text/event-stream"
+                    else:
+                        payload = json.dumps({"choices": [{"message": {"content": content}}], "usage": usage},
+                                             ensure_ascii=False).encode()
+                        content_type = "application/json"
+                    status = "200 OK"
+                writer.write(f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+                             f"Content-Length: {len(payload)}\r\n\r\n".encode() + payload)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except asyncio.CancelledError:
+            # Запрос, отмененный клиентом (хеджирование), досыпает до остановки сервера
+            pass
+        finally:
+            writer.close()
+
+# ---------- Поддельный Telegram ----------
+
+class FakeMessage:
+    def __init__(self, message_id, chat_id, text="", reply_markup=None):
+        self.message_id = message_id
+        self.chat_id = chat_id
+        self.chat = types.SimpleNamespace(id=chat_id)
+        self.text = text
+        self.reply_markup = reply_markup
+
+class FakeBot:
+    """Bot API в памяти: записывает сообщения и завершает ожидающие операции игроков"""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.next_id = 1
+        self.calls = 0
+        self.pending = defaultdict(deque)  # chat_id -> [(предикат, future)]
+        self.offers = {}  # (отправитель, получатель) -> callback_data принятия
+
+    def expect(self, chat_id, predicate):
+        """Ожидает в чате сообщение, подходящее под предикат"""
+        future = asyncio.get_running_loop().create_future()
+        self.pending[chat_id].append((predicate, future))
+        return future
+
+    def deliver(self, chat_id, text, reply_markup):
+        if reply_markup is not None:
+            data = reply_markup.inline_keyboard[0][0].callback_data
+            sender_id, receiver_id = data[len("accept_"):].split("_")[:2]
+            self.offers[(int(sender_id), int(receiver_id))] = data
+        waiting = self.pending.get(chat_id)
+        if not waiting:
+            return
+        for entry in waiting:
+            predicate, future = entry
+            if predicate(text):
+                waiting.remove(entry)
+                if not future.done():
+                    future.set_result(time.perf_counter())
+                break
+
+    async def _call(self):
+        self.calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    async def send_message(self, chat_id, text, reply_markup=None, **kwargs):
+        await self._call()
+        self.next_id += 1
+        self.deliver(chat_id, text, reply_markup)
+        return FakeMessage(self.next_id, chat_id, text, reply_markup)
+
+    async def edit_message_text(self, text, chat_id, message_id, **kwargs):
+        await self._call()
+        self.deliver(chat_id, text, kwargs.get("reply_markup"))
+        return True
+
+    async def delete_message(self, chat_id, message_id, **kwargs):
+        await self._call()
+        return True
+
+class FakeApplication:
+    def __init__(self, bot):
+        self.bot = bot
+        self.tasks = []
+
+    def create_task(self, coroutine, *args, **kwargs):
+        task = asyncio.get_running_loop().create_task(coroutine)
+        self.tasks.append(task)
+        return task
+
+class FakeCallbackQuery:
+    def __init__(self, data, user, message):
+        self.data = data
+        self.from_user = user
+        self.message = message
+
+    async def answer(self, *args, **kwargs):
+        pass
+
+def make_user(user_id):
+    return types.SimpleNamespace(id=user_id, username=f"player{user_id}", first_name=f"Игрок{user_id}")
+
+def make_update(user, text, message_id):
+    chat = types.SimpleNamespace(id=user.id)
+    message = FakeMessage(message_id, user.id, text)
+    return types.SimpleNamespace(effective_user=user, effective_chat=chat, message=message, callback_query=None)
+
+def make_context(application, args=None):
+    return types.SimpleNamespace(args=args or [], bot=application.bot, application=application, error=None)
+
+# ---------- Измерения ----------
+
+def is_action_answer(text):
+    return (text.startswith("📊") and not text.endswith("▌")) or (
+        text.startswith("❌") and not text.startswith(("❌ Передача", "❌ Ошибка при выполнении передачи")))
+
+PREDICATES = {
+    "action": is_action_answer,
+    "profile": lambda text: text.lstrip().startswith("👤") or text.startswith("❌"),
+    "top": lambda text: text.startswith(("🏆", "📊 Пока")),
+    "transfer": lambda text: text.startswith(("✅ Запрос", "❌")),
+    "accept": lambda text: text.startswith(("✅ Передача", "❌ Передача", "❌ Ошибка при выполнении передачи")),
+}
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+def disk_bytes_written():
+    """Байты, записанные процессом (Linux /proc/self/io)"""
+    try:
+        with open("/proc/self/io") as f:
+            for line in f:
+                if line.startswith("wchar:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+async def run_benchmark(args):
+    import api
+    import main
+    from dispatcher import dispatcher, TokenBucket
+
+    # Медленный хвост - у основных моделей; запасные отвечают с обычной задержкой
+    llm = MockLLMServer(args.llm_latency, args.llm_sigma, args.failure_rate, args.seed,
+                        [targets[0][1] for targets in api.routes.values()], args.tail_share, args.tail_latency)
+    url = await llm.start()
+    for backend in api.backends.values():
+        backend.url = url
+    api.AI_HEDGE = not args.no_hedge
+    local = None
+    if args.outage:
+        # Основной сервер отвечает только 503; локальный сервер в конце каждого маршрута исправен
+        llm.failure_rate = 1.0
+        local = MockLLMServer(args.llm_latency, args.llm_sigma, 0, args.seed + 1)
+        backend = api.backends["local"] = api.OpenAIBackend("local", await local.start())
+        for targets in api.routes.values():
+            targets.append((backend, "local-model"))
+    bot = FakeBot(args.telegram_latency)
+    application = FakeApplication(bot)
+    if not args.real_limits:
+        dispatcher.global_bucket = TokenBucket(1e6, 1e6)
+        dispatcher.chat_rate = dispatcher.chat_burst = 1e6
+
+    # Время ожидания в очереди: от постановки до начала обработки
+    queue_waits = []
+    enqueued = defaultdict(deque)
+    enqueue_action, process_action = main.enqueue_action, main.process_action
+
+    admitted = defaultdict(list)  # итоги приема сообщений игрока в очередь
+
+    def timed_enqueue(update, context, user_input):
+        result = enqueue_action(update, context, user_input)
+        if result == main.ADMIT_QUEUED:
+            enqueued[update.effective_user.id].append(time.perf_counter())
+        admitted[update.effective_user.id].append(result)
+        return result
+
+    async def timed_process(update, *rest):
+        queue_waits.append(time.perf_counter() - enqueued[update.effective_user.id].popleft())
+        await process_action(update, *rest)
+
+    main.enqueue_action, main.process_action = timed_enqueue, timed_process
+    if args.queue_cap:
+        main.MAX_QUEUED_ACTIONS = args.queue_cap
+    await main.on_startup(application)
+
+    rng = random.Random(args.seed)
+    users = [make_user(100000 + i) for i in range(args.players)]
+    latencies = defaultdict(list)
+    errors = defaultdict(int)
+    message_ids = iter(range(1, 10 ** 9))
+
+    async def timed(kind, chat_id, call):
+        future = bot.expect(chat_id, PREDICATES[kind])
+        started = time.perf_counter()
+        await call
+        try:
+            finished = await asyncio.wait_for(future, args.op_timeout)
+            latencies[kind].append(finished - started)
+        except asyncio.TimeoutError:
+            errors[kind] += 1
+
+    async def timed_burst(user):
+        """Несколько сообщений подряд: ответ ожидается на каждое принятое действие,
+        дописанные и отклоненные сообщения отдельного ответа ИИ не получают"""
+        admitted.pop(user.id, None)
+        started = time.perf_counter()
+        for i in range(args.burst):
+            await main.handle_message(make_update(user, f"Поработаю курьером, смена {i + 1}", next(message_ids)),
+                                      make_context(application))
+        futures = [bot.expect(user.id, PREDICATES["action"])
+                   for result in admitted.pop(user.id, []) if result == main.ADMIT_QUEUED]
+        for future in futures:
+            try:
+                finished = await asyncio.wait_for(future, args.op_timeout)
+                latencies["action"].append(finished - started)
+            except asyncio.TimeoutError:
+                errors["action"] += 1
+
+    for user in users:
+        await main.start(make_update(user, "/start", next(message_ids)), make_context(application))
+
+    async def player(user):
+        for _ in range(args.ops):
+            roll = rng.random()
+            if roll < args.transfer_share:
+                receiver = rng.choice(users)
+                if receiver is user:
+                    continue
+                text = f"передать 1$ игроку {receiver.id}"
+                await timed("transfer", user.id, main.handle_message(
+                    make_update(user, text, next(message_ids)), make_context(application)))
+                data = bot.offers.pop((user.id, receiver.id), None)
+                if data is not None:
+                    query = FakeCallbackQuery(data, receiver, FakeMessage(next(message_ids), receiver.id))
+                    update = types.SimpleNamespace(callback_query=query, effective_user=receiver,
+                                                   effective_chat=query.message.chat, message=None)
+                    await timed("accept", receiver.id, main.button_handler(update, make_context(application)))
+            elif roll < args.transfer_share + 0.1:
+                await timed("top", user.id, main.top_players(
+                    make_update(user, "/top", next(message_ids)), make_context(application)))
+            elif roll < args.transfer_share + 0.2:
+                await timed("profile", user.id, main.profile(
+                    make_update(user, "/profile", next(message_ids)), make_context(application)))
+            elif args.burst > 1:
+                await timed_burst(user)
+            else:
+                await timed("action", user.id, main.handle_message(
+                    make_update(user, "Поработаю курьером", next(message_ids)), make_context(application)))
+
+    written_before = disk_bytes_written()
+    started = time.perf_counter()
+    await asyncio.gather(*(player(user) for user in users))
+    elapsed = time.perf_counter() - started
+    main.flush_user_data()
+    written = disk_bytes_written() - written_before
+
+    for task in application.tasks:
+        task.cancel()
+    await llm.stop()
+    if local is not None:
+        await local.stop()
+    await api.close_client()
+
+    total = sum(len(v) for v in latencies.values())
+    report = {
+        "players": args.players,
+        "operations": total,
+        "errors": dict(errors),
+        "elapsed_s": round(elapsed, 3),
+        "throughput_ops_s": round(total / elapsed, 2) if elapsed else 0,
+        "llm_requests": llm.requests,
+        "llm_failures": llm.failures,
+        "llm_hedge": dict(api.hedge_stats),
+        "llm_backends": {name: backend.breaker.state for name, backend in api.backends.items()},
+        "llm_local_requests": local.requests if local is not None else 0,
+        "admission": dict(main.admission_stats),
+        "telegram_calls": bot.calls,
+        "disk_bytes_per_action": round(written / max(1, len(latencies["action"]))),
+        "queue_wait_s": {
+            "p50": round(percentile(queue_waits, 0.50), 4),
+            "p95": round(percentile(queue_waits, 0.95), 4),
+            "p99": round(percentile(queue_waits, 0.99), 4),
+        },
+        "latency_s": {
+            kind: {
+                "count": len(values),
+                "p50": round(percentile(values, 0.50), 4),
+                "p95": round(percentile(values, 0.95), 4),
+                "p99": round(percentile(values, 0.99), 4),
+            } for kind, values in sorted(latencies.items())
+        },
+    }
+    return report
+
+# ---------- Записи игроков ----------
+
+def make_record(user_id, rng):
+    """Типичный игрок: несколько предметов, 5 последних реплик, краткое содержание"""
+    return {
+        "user_id": user_id,
+        "username": f"player{user_id}",
+        "first_name": f"Игрок{user_id}",
+        "balance": rng.randint(0, 100000),
+        "inventory": {f"предмет {i}": rng.randint(1, 5) for i in range(rng.randint(0, 10))},
+        "message_history": [
+            {"role": "user" if i % 2 == 0 else "assistant", "content": "Иду на работу и покупаю кофе. " * 4}
+            for i in range(5)
+        ],
+        "registered_date": "2024-01-01T00:00:00",
+        "summary": "Игрок работает курьером и копит на машину.",
+    }
+
+def measure_format(records, encode, decode):
+    encoded = []
+    started = time.perf_counter()
+    for record in records:
+        encoded.append(encode(record))
+    save_time = time.perf_counter() - started
+
+    tracemalloc.start()
+    started = time.perf_counter()
+    decoded = [decode(raw) for raw in encoded]
+    load_time = time.perf_counter() - started
+    memory, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del decoded
+
+    count = len(records)
+    return {
+        "save_us": round(save_time / count * 1e6, 2),
+        "load_us": round(load_time / count * 1e6, 2),
+        "bytes": round(sum(len(raw) for raw in encoded) / count),
+        "memory_bytes": round(memory / count),
+    }
+
+def benchmark_records(count, seed=1):
+    """Сравнивает прежний формат (словарь, json с отступами) с Player и его кодеком:
+    время сохранения и загрузки, размер записи и память на игрока в кэше"""
+    from player import Player, encode, decode
+    rng = random.Random(seed)
+    records = [make_record(user_id, rng) for user_id in range(count)]
+    players = [Player.from_dict(record) for record in records]
+    return {
+        "records": count,
+        "dict_json_indent": measure_format(
+            records, lambda r: json.dumps(r, ensure_ascii=False, indent=2).encode(), json.loads),
+        "player_codec": measure_format(players, encode, decode),
+    }
+
+# ---------- Распознавание намерений ----------
+
+def load_corpus(path=INTENT_CORPUS):
+    """Размеченные строки корпуса: [(разметка, текст)]"""
+    with open(path, encoding="utf-8") as f:
+        return [tuple(line.rstrip("\n").split("\t", 1)) for line in f if line.strip() and not line.startswith("#")]
+
+def substring_router(text):
+    """Прежнее правило handle_message: передача, если в тексте есть подстрока глагола"""
+    return "transfer" if any(word in text.lower() for word in ("передать", "кинуть", "отдать", "дать")) else "action"
+
+def evaluate_router(route, corpus, mistakes=True):
+    """Точность и полнота по каждому намерению"""
+    predictions = [(label, route(text), text) for label, text in corpus]
+    report = {}
+    for label in sorted({label for label, _ in corpus}):
+        hits = sum(1 for expected, got, _ in predictions if expected == got == label)
+        predicted = sum(1 for _, got, _ in predictions if got == label)
+        actual = sum(1 for expected, _, _ in predictions if expected == label)
+        report[label] = {
+            "precision": round(hits / predicted, 3) if predicted else 0.0,
+            "recall": round(hits / actual, 3),
+            "support": actual,
+        }
+    report["accuracy"] = round(sum(expected == got for expected, got, _ in predictions) / len(predictions), 3)
+    if mistakes:
+        report["mistakes"] = [f"{expected} -> {got}: {text}" for expected, got, text in predictions if expected != got]
+    return report
+
+def benchmark_intents(duration=1.0):
+    """Сравнивает классификатор intent.py с прежним правилом на размеченном корпусе
+    и измеряет скорость классификации"""
+    from intent import classify
+    corpus = load_corpus()
+    texts = [text for _, text in corpus]
+    count = 0
+    started = time.perf_counter()
+    while time.perf_counter() - started < duration:
+        for text in texts:
+            classify(text)
+        count += len(texts)
+    elapsed = time.perf_counter() - started
+    return {
+        "messages": len(corpus),
+        "router": evaluate_router(classify, corpus),
+        "substring_rule": evaluate_router(substring_router, corpus, mistakes=False),
+        "router_us_per_message": round(elapsed / count * 1e6, 2),
+        "router_messages_per_s": round(count / elapsed),
+    }
+
+# ---------- Разбор команд передачи ----------
+
+def parse_expected_transfer(label):
+    """Ожидаемый разбор из корпуса: (деньги, предметы, получатель, сообщение) или None для ai"""
+    if label == "ai":
+        return None
+    money, items, receiver_id, message = label.split("|", 3)
+    parts = (part.rsplit(":", 1) for part in items.split(",") if part)
+    return int(money), {name: int(quantity) for name, quantity in parts}, int(receiver_id), message
+
+def benchmark_transfer_parse(duration=1.0):
+    """Сверяет parse_transfer_local с разметкой каждой команды корпуса
+    и измеряет долю локального разбора и скорость"""
+    from transfer import parse_transfer_local
+    corpus = [(parse_expected_transfer(label), text) for label, text in load_corpus(TRANSFER_CORPUS)]
+    mistakes = []
+    for expected, text in corpus:
+        parsed = parse_transfer_local(text, TRANSFER_CORPUS_INVENTORY)
+        if parsed != expected:
+            mistakes.append(f"{text}: ожидалось {expected}, получено {parsed}")
+
+    texts = [text for _, text in corpus]
+    count = local = 0
+    started = time.perf_counter()
+    while time.perf_counter() - started < duration:
+        for text in texts:
+            if parse_transfer_local(text, TRANSFER_CORPUS_INVENTORY) is not None:
+                local += 1
+        count += len(texts)
+    elapsed = time.perf_counter() - started
+    return {
+        "commands": len(corpus),
+        "local_hit_rate": round(local / count, 3),
+        "ai_fallback_rate": round(1 - local / count, 3),
+        "us_per_parse": round(elapsed / count * 1e6, 2),
+        "parses_per_s": round(count / elapsed),
+        "mistakes": mistakes,
+    }
+
+# ---------- Сохранение денег и предметов ----------
+
+def count_totals(players):
+    """Сумма денег и предметов у игроков"""
+    money = items = 0
+    for player in players:
+        money += player.balance
+        items += player.inventory.total
+    return money, items
+
+async def run_conservation_check(args):
+    """Тысячи передач идут одновременно с действиями игроков: пока ИИ отвечает, передачи
+    списывают и зачисляют деньги и предметы тех же игроков, а кэш мал и вытесняет их.
+    В конце деньги и предметы всех игроков должны равняться начальным плюс изменения,
+    которые задумал ИИ (ответ ИИ - новый баланс относительно баланса в запросе)"""
+    import api
+    import prompt
+    import context
+    from player import Player
+    from transfer import create_transfer, execute_transfer
+    from config import AI_WORKERS
+
+    rng = random.Random(args.seed)
+    user_ids = list(range(1, args.players + 1))
+    for user_id in user_ids:
+        prompt.storage.save(Player.from_dict(make_record(user_id, rng)))
+    prompt.user_cache.max_size = max(10, args.players // 10)
+
+    llm = MockLLMServer(args.llm_latency, args.llm_sigma, 0, args.seed, item_share=0.5)
+    url = await llm.start()
+    for backend in api.backends.values():
+        backend.url = url
+
+    initial_money, initial_items = await prompt.run_io(lambda: count_totals(prompt.iter_all_users()))
+
+    # Изменения, которые внесли ответы ИИ; применяются в потоках работы с диском
+    expected = {"money": 0, "items": 0}
+    stats = defaultdict(int)
+    stats_lock = threading.Lock()
+    apply_action_result = prompt.apply_action_result
+
+    def recording_apply(user_data, parsed, shown_balance):
+        old_balance, new_balance, changes, codes = apply_action_result(user_data, parsed, shown_balance)
+        with stats_lock:
+            if "insufficient_funds" in codes:
+                stats["actions_rejected"] += 1
+            elif parsed["balance"] is not None:
+                expected["money"] += parsed["balance"] - shown_balance
+            expected["items"] += sum(new - old for old, new in changes.values())
+        return old_balance, new_balance, changes, codes
+
+    prompt.apply_action_result = recording_apply
+
+    async def transfers(count):
+        for _ in range(count):
+            sender_id, receiver_id = rng.sample(user_ids, 2)
+            items = {f"предмет {rng.randrange(10)}": 1} if rng.random() < 0.5 else {}
+            created, transfer_id = await prompt.run_io(
+                create_transfer, sender_id, receiver_id, rng.randint(1, 300), items, "")
+            if not created:
+                stats["transfers_invalid"] += 1
+                continue
+            done, _ = await prompt.run_io(execute_transfer, transfer_id)
+            stats["transfers_done" if done else "transfers_rejected"] += 1
+
+    # Как в очереди main.py: действия одного игрока идут по очереди, одновременно - не больше AI_WORKERS
+    slots = asyncio.Semaphore(AI_WORKERS)
+
+    async def actions(user_id):
+        for _ in range(args.ops):
+            async with slots, prompt.active_user(user_id) as user_data:
+                await prompt.process_user_action("Поработаю курьером", user_data)
+            stats["actions"] += 1
+
+    workers = 32
+    started = time.perf_counter()
+    await asyncio.gather(
+        *(transfers(args.conservation // workers + (i < args.conservation % workers)) for i in range(workers)),
+        *(actions(user_id) for user_id in user_ids))
+    await asyncio.gather(*list(context._tasks), return_exceptions=True)
+    elapsed = time.perf_counter() - started
+
+    final_money, final_items = await prompt.run_io(lambda: count_totals(prompt.iter_all_users()))
+    await llm.stop()
+    await api.close_client()
+
+    money = {"initial": initial_money, "expected": initial_money + expected["money"], "final": final_money}
+    items = {"initial": initial_items, "expected": initial_items + expected["items"], "final": final_items}
+    return {
+        "players": args.players,
+        "elapsed_s": round(elapsed, 3),
+        **dict(sorted(stats.items())),
+        "money": money,
+        "items": items,
+        "conserved": money["final"] == money["expected"] and items["final"] == items["expected"],
+    }
+
+# ---------- Задержка команд во время просмотра хранилища ----------
+
+def latency_stats(values, duration):
+    return {
+        "count": len(values),
+        "duration_s": round(duration, 3),
+        "p50": round(percentile(values, 0.50), 4),
+        "p99": round(percentile(values, 0.99), 4),
+        "max": round(max(values, default=0), 4),
+    }
+
+async def run_scan_benchmark(args):
+    """Команды /balance и /profile ID идут каждые 2 мс, пока рейтинг перестраивается
+    по всему хранилищу: сначала в потоке работы с диском, затем прямо в цикле событий.
+    p99 команд во время просмотра в потоке должна оставаться на уровне простоя:
+    не выше idle.p99 * SCAN_P99_FACTOR + SCAN_P99_SLACK"""
+    import main
+    import prompt
+    from player import Player
+    from dispatcher import dispatcher, TokenBucket
+
+    rng = random.Random(args.seed)
+    for user_id in range(1, args.scan + 1):
+        prompt.storage.save(Player.from_dict(make_record(user_id, rng)))
+
+    bot = FakeBot(0)
+    application = FakeApplication(bot)
+    dispatcher.global_bucket = TokenBucket(1e6, 1e6)
+    dispatcher.chat_rate = dispatcher.chat_burst = 1e6
+    await main.on_startup(application)
+
+    users = [make_user(10 ** 6 + i) for i in range(100)]
+    message_ids = iter(range(1, 10 ** 9))
+    for user in users:
+        await main.start(make_update(user, "/start", next(message_ids)), make_context(application))
+
+    def is_answer(text):
+        return text.startswith(("💰", "❌")) or text.lstrip().startswith("👤")
+
+    async def probe(user, command_args, scheduled):
+        # Половина команд - профиль игрока, которого нет в кэше (чтение с диска)
+        future = bot.expect(user.id, is_answer)
+        handler = main.profile if command_args else main.balance
+        await handler(make_update(user, "/cmd", next(message_ids)), make_context(application, command_args))
+        await future
+        return time.perf_counter() - scheduled
+
+    async def measure(scan):
+        # Задержка считается от запланированного времени команды: команды, которые
+        # не могли начаться, пока цикл событий был занят, учитываются с ожиданием
+        probes = []
+        started = next_at = time.perf_counter()
+        running = asyncio.ensure_future(scan)
+        while True:
+            while next_at <= time.perf_counter():
+                command_args = [str(rng.randint(1, args.scan))] if rng.random() < 0.5 else None
+                probes.append(asyncio.ensure_future(probe(rng.choice(users), command_args, next_at)))
+                next_at += 0.002
+            if running.done():
+                break
+            await asyncio.sleep(max(0, next_at - time.perf_counter()))
+        return latency_stats(await asyncio.gather(*probes), time.perf_counter() - started)
+
+    def rebuild():
+        prompt.leaderboard.build(prompt.iter_all_users())
+
+    async def scan_in_executor():
+        await asyncio.sleep(0.05)
+        await prompt.run_io(rebuild)
+
+    async def scan_on_loop():
+        await asyncio.sleep(0.05)
+        rebuild()
+
+    await measure(asyncio.sleep(0.3))  # прогрев: потоки работы с диском, кэш
+    report = {
+        "stored_players": args.scan,
+        "idle": await measure(asyncio.sleep(1)),
+        "scan_in_executor": await measure(scan_in_executor()),
+        "scan_on_loop": await measure(scan_on_loop()),
+    }
+    report["p99_bound"] = round(report["idle"]["p99"] * SCAN_P99_FACTOR + SCAN_P99_SLACK, 4)
+    report["within_bound"] = report["scan_in_executor"]["p99"] <= report["p99_bound"]
+    for task in application.tasks:
+        task.cancel()
+    return report
+
+def compare_with_baseline(report, baseline, tolerance):
+    """Возвращает список регрессий относительно эталона"""
+    regressions = []
+    if report["throughput_ops_s"] < baseline["throughput_ops_s"] * (1 - tolerance):
+        regressions.append(f"пропускная способность: {report['throughput_ops_s']} < {baseline['throughput_ops_s']}")
+    for kind, stats in report["latency_s"].items():
+        base = baseline.get("latency_s", {}).get(kind)
+        if base and stats["p95"] > base["p95"] * (1 + tolerance):
+            regressions.append(f"{kind} p95: {stats['p95']}s > {base['p95']}s")
+    if report["disk_bytes_per_action"] > baseline["disk_bytes_per_action"] * (1 + tolerance):
+        regressions.append(f"запись на диск: {report['disk_bytes_per_action']} > {baseline['disk_bytes_per_action']} байт/действие")
+    return regressions
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота")
+    parser.add_argument("--players", type=int, default=1000)
+    parser.add_argument("--ops", type=int, default=5, help="операций на игрока")
+    parser.add_argument("--transfer-share", type=float, default=0.1, help="доля передач среди операций")
+    parser.add_argument("--llm-latency", type=float, default=0.5, help="медианная задержка ИИ, с")
+    parser.add_argument("--llm-sigma", type=float, default=0.5, help="разброс задержки (логнормальный)")
+    parser.add_argument("--failure-rate", type=float, default=0.01, help="доля ответов 503")
+    parser.add_argument("--tail-share", type=float, default=0, help="доля очень медленных ответов основной модели")
+    parser.add_argument("--tail-latency", type=float, default=10, help="задержка медленного ответа, с")
+    parser.add_argument("--no-hedge", action="store_true", help="не дублировать медленные запросы к ИИ")
+    parser.add_argument("--outage", action="store_true",
+                        help="основной сервер ИИ недоступен, запросы должны перейти на локальный")
+    parser.add_argument("--burst", type=int, default=0, help="сообщений подряд в каждом игровом действии")
+    parser.add_argument("--queue-cap", type=int, default=0, help="лимит ожидающих действий (MAX_QUEUED_ACTIONS)")
+    parser.add_argument("--telegram-latency", type=float, default=0.02, help="задержка вызова Bot API, с")
+    parser.add_argument("--real-limits", action="store_true", help="соблюдать лимиты Telegram")
+    parser.add_argument("--op-timeout", type=float, default=120)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--tolerance", type=float, default=0.2, help="допустимое ухудшение относительно эталона")
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--records", type=int, default=0, help="только сравнить форматы записи на N игроках")
+    parser.add_argument("--intents", action="store_true", help="только проверить распознавание намерений")
+    parser.add_argument("--scan", type=int, default=0,
+                        help="только задержка команд во время просмотра хранилища из N игроков")
+    parser.add_argument("--transfer-parse", action="store_true",
+                        help="только проверить локальный разбор команд передачи на transfer_corpus.tsv")
+    parser.add_argument("--conservation", type=int, default=0,
+                        help="только проверить сохранение денег и предметов на N одновременных передачах")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.records:
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        print(json.dumps(benchmark_records(args.records, args.seed), ensure_ascii=False, indent=2))
+        return 0
+    if args.intents:
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        print(json.dumps(benchmark_intents(), ensure_ascii=False, indent=2))
+        return 0
+
+    workdir = tempfile.mkdtemp(prefix="lifesim-bench-")
+    shutil.copy(PROMPT_SOURCE, os.path.join(workdir, "prompt.txt"))
+    os.chdir(workdir)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    try:
+        # transfer.py при импорте открывает хранилище, поэтому разбор тоже проверяется во временной папке
+        if args.transfer_parse:
+            report = benchmark_transfer_parse()
+        elif args.conservation:
+            report = asyncio.run(run_conservation_check(args))
+        else:
+            report = asyncio.run(run_scan_benchmark(args) if args.scan else run_benchmark(args))
+    finally:
+        os.chdir("/")
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    if args.transfer_parse:
+        return 1 if report["mistakes"] else 0
+    if args.conservation:
+        return 0 if report["conserved"] else 1
+    if args.scan:
+        return 0 if report["within_bound"] else 1
+
+    if args.save_baseline:
+        with open(BASELINE_FILE, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"Эталон сохранен: {BASELINE_FILE}")
+        return 0
+
+    if os.path.exists(BASELINE_FILE):
+        with open(BASELINE_FILE, encoding="utf-8") as f:
+            regressions = compare_with_baseline(report, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"РЕГРЕССИЯ: {regression}")
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
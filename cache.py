@@ -0,0 +1,152 @@
+import threading
+from itertools import islice
+from contextlib import contextmanager
+from collections import OrderedDict
+
+class UserCache:
+    """LRU кэш данных игроков с отложенной записью на диск.
+
+    Чтение промахов и запись на диск идут без блокировки записей кэша, поэтому
+    поток, занятый диском, не задерживает обращения к уже загруженным игрокам.
+    Закрепленные записи (pinned) не вытесняются: объект, который держит действие,
+    остается тем же, что и в кэше, и изменения других потоков не теряются.
+    flush_threshold=None - не записывать при put: сброс делает владелец кэша"""
+
+    def __init__(self, load_func, save_func, max_size=10000, flush_threshold=100):
+        self.load_func = load_func
+        self.save_func = save_func
+        self.max_size = max_size
+        self.flush_threshold = flush_threshold
+        self._records = OrderedDict()
+        self._dirty = set()
+        self._writing = set()  # игроки, которых записывает текущий сброс
+        self._pins = {}  # ID игрока -> число закреплений
+        self._lock = threading.RLock()
+        self._flush_lock = threading.Lock()  # сбросы выполняются по одному
+        self.stats = {"hits": 0, "misses": 0, "writes": 0}
+
+    def get(self, user_id):
+        """Возвращает данные игрока из кэша или с диска (None если игрока нет)"""
+        user_data = self.cached(user_id)
+        if user_data is not None:
+            return user_data
+
+        with self._lock:
+            self.stats["misses"] += 1
+        loaded = self.load_func(user_id)
+        if loaded is None:
+            return None
+        with self._lock:
+            # Пока шло чтение, игрока могли загрузить или изменить в другом потоке
+            user_data = self._records.setdefault(user_id, loaded)
+            self._records.move_to_end(user_id)
+            self._evict()
+        return user_data
+
+    def cached(self, user_id):
+        """Данные игрока, если они уже в кэше (без обращения к диску)"""
+        with self._lock:
+            user_data = self._records.get(user_id)
+            if user_data is not None:
+                self._records.move_to_end(user_id)
+                self.stats["hits"] += 1
+            return user_data
+
+    @contextmanager
+    def pinned(self, user_id):
+        """Закрепляет запись игрока в кэше на время блока.
+        Закреплять нужно до загрузки, иначе запись могут вытеснить между загрузкой и закреплением"""
+        with self._lock:
+            self._pins[user_id] = self._pins.get(user_id, 0) + 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                pins = self._pins.pop(user_id) - 1
+                if pins:
+                    self._pins[user_id] = pins
+                self._evict()
+
+    def put(self, user_data):
+        """Помечает данные игрока измененными"""
+        with self._lock:
+            user_id = user_data.user_id
+            self._records[user_id] = user_data
+            self._records.move_to_end(user_id)
+            self._dirty.add(user_id)
+            self._evict()
+            flush = self.flush_threshold is not None and len(self._dirty) >= self.flush_threshold
+        if flush:
+            self.flush()
+
+    def flush(self, user_ids=None):
+        """Записывает измененные данные на диск. Возвращает False при ошибке записи.
+        Сбросы идут по одному, поэтому после возврата данные игроков уже на диске,
+        даже если их начал записывать сброс из другого потока"""
+        with self._flush_lock:
+            with self._lock:
+                targets = set(self._dirty) if user_ids is None else self._dirty & set(user_ids)
+                self._dirty -= targets
+                self._writing = targets
+                records = [self._records[user_id] for user_id in targets]
+
+            success = True
+            for user_data in records:
+                try:
+                    self.save_func(user_data)
+                except Exception as e:
+                    print(f"Ошибка сохранения пользователя {user_data.user_id}: {e}")
+                    success = False
+                    with self._lock:
+                        self._dirty.add(user_data.user_id)
+                    continue
+                with self._lock:
+                    self.stats["writes"] += 1
+
+            with self._lock:
+                self._writing = set()
+                self._evict()
+            return success
+
+    def write_through(self, records, merge):
+        """Записывает записи на диск сразу и только после записи всех переносит их
+        в загруженные объекты: merge(объект в кэше, запись). Сбросы в это время
+        не идут и не запишут поверх устаревший объект.
+        При ошибке записи исключение пробрасывается, а объекты в кэше не меняются"""
+        with self._flush_lock:
+            for record in records:
+                self.save_func(record)
+            with self._lock:
+                self.stats["writes"] += len(records)
+                for record in records:
+                    user_data = self._records.get(record.user_id)
+                    if user_data is not None:
+                        merge(user_data, record)
+
+    def rewrite(self, user_ids):
+        """Записывает загруженных игроков на диск, даже если они не менялись.
+        До успешной записи они помечены измененными и не вытесняются"""
+        with self._lock:
+            self._dirty |= set(user_ids) & self._records.keys()
+        return self.flush(user_ids)
+
+    def _evict(self):
+        # Несохраненные и закрепленные игроки остаются в кэше, даже сверх max_size
+        excess = len(self._records) - self.max_size
+        if excess <= 0:
+            return
+        candidates = list(islice(self._records, excess + len(self._dirty) + len(self._writing) + len(self._pins)))
+        for user_id in candidates:
+            if excess <= 0:
+                break
+            if user_id in self._dirty or user_id in self._writing or user_id in self._pins:
+                continue
+            del self._records[user_id]
+            excess -= 1
+
+    def dirty_count(self):
+        """Число измененных, но еще не записанных игроков"""
+        return len(self._dirty)
+
+    def __len__(self):
+        return len(self._records)
@@ -4,5 +4,109 @@ TELEGRAM_TOKEN = "73*****65:AAFNEYY************7kY"
 PROMPT_FILE = "prompt.txt"
 USERS_DIR = "users"
 
+# Хранилище игроков: "json" (файлы в USERS_DIR) или "sqlite"
+STORAGE_BACKEND = "json"
+SQLITE_PATH = "lifesim.db"
+LEADERBOARD_FILE = "leaderboard.json"
+TRANSFER_JOURNAL = "transfers.journal"
+
+# Передачи
+PENDING_TRANSFERS_DB = "pending_transfers.db"
+PENDING_TRANSFER_TTL = 3600  # секунд на подтверждение
+PENDING_EXPIRY_INTERVAL = 30  # секунд между проверками
+MAX_PENDING_PER_SENDER = 5
+
+# API ИИ
+API_URL = "https://openrouter.ai/api/v1/chat/completions"
+# Серверы ИИ. type: "openrouter" или "openai" - любой OpenAI-совместимый сервер
+# (llama.cpp, vLLM, Ollama). max_concurrent - одновременных запросов к серверу,
+# max_queue - запросов в ожидании места, сверх них запрос уходит другому серверу
+AI_BACKENDS = {
+    "openrouter": {"type": "openrouter", "url": API_URL, "api_key": API_KEY, "max_concurrent": 8, "max_queue": 64},
+    # "local": {"type": "openai", "url": "http://127.0.0.1:8000/v1/chat/completions",
+    #           "max_concurrent": 2, "max_queue": 16},
+}
+# Модели по видам вызовов: первая - основная, следующие - запасные (хеджирование и
+# переключение при сбоях). Запись "сервер:модель"; без сервера - первый из AI_BACKENDS.
+# Повествование - модель крупнее, разбор команд и краткая память - быстрая и дешевая
+AI_ROUTES = {
+    "narration": ["openai/gpt-4o-mini", "openai/gpt-3.5-turbo"],
+    "parse": ["google/gemini-flash-1.5-8b", "openai/gpt-4o-mini"],
+    "summary": ["google/gemini-flash-1.5-8b", "openai/gpt-4o-mini"],
+}
+API_TIMEOUT = 30  # секунд на одну попытку
+API_TOTAL_TIMEOUT = 60  # секунд на все попытки
+API_MAX_RETRIES = 3
+API_RETRY_BASE_DELAY = 0.5
+API_RETRY_MAX_DELAY = 8
+# Хеджирование: если основная модель не ответила за p95 своих недавних ответов,
+# тот же запрос уходит запасной модели и берется первый пригодный ответ
+AI_HEDGE = True
+AI_HEDGE_QUANTILE = 0.95
+AI_HEDGE_DEFAULT_DELAY = 5  # секунд, пока по модели мало замеров
+AI_HEDGE_MIN_DELAY = 1
+AI_HEDGE_MAX_DELAY = 15
+AI_LATENCY_WINDOW = 200  # последних ответов модели для оценки p95
+# Размыкатель: после стольких сбоев подряд сервер пропускается на AI_BREAKER_COOLDOWN секунд
+AI_BREAKER_FAILURES = 3
+AI_BREAKER_COOLDOWN = 30
+
+# Контекст ИИ
+CONTEXT_TOKEN_BUDGET = 3000  # токенов на промпт, историю и запрос
+SUMMARY_BATCH = 4  # реплик, после которых обновляется краткое содержание
+SUMMARY_MAX_CHARS = 600
+
+# Потоковый вывод ответа ИИ в сообщение "Думаю..."
+STREAMING = False
+STREAM_EDIT_INTERVAL = 1.5  # секунд между правками сообщения (лимиты Telegram)
+
+# Отправка сообщений (лимиты Telegram)
+TELEGRAM_GLOBAL_RATE = 30  # сообщений в секунду на всего бота
+TELEGRAM_CHAT_RATE = 1  # сообщений в секунду в один чат
+TELEGRAM_CHAT_BURST = 3
+SEND_WORKERS = 8
+
 # Лимиты
-MAX_INVENTORY_ITEMS = 999
+MAX_INVENTORY_ITEMS = 999  # одного предмета
+INVENTORY_SLOTS = 20  # всего предметов в инвентаре
+
+# Очередь ИИ
+AI_WORKERS = 8
+MAX_USER_ACTIONS = 3  # действий одного игрока: выполняемое и ожидающие
+MAX_QUEUED_ACTIONS = 1000  # ожидающих действий всех игроков; сверх - новые действия отклоняются
+ACTION_COALESCE_WINDOW = 3  # секунд: сообщения, пришедшие подряд, дописываются к ожидающему действию
+MAX_COALESCED_MESSAGES = 5  # сообщений в одном действии
+QUEUE_POSITION_INTERVAL = 5  # секунд между обновлениями позиции в очереди
+
+# Кэш игроков
+USER_CACHE_SIZE = 10000
+CACHE_FLUSH_INTERVAL = 5  # секунд
+CACHE_FLUSH_THRESHOLD = 100  # измененных игроков
+IO_WORKERS = 4  # потоков для работы с диском, чтобы чтение и запись не останавливали цикл событий
+
+# Метрики
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9100  # None - не запускать HTTP эндпоинт /metrics
+METRICS_LOG_INTERVAL = 300  # секунд между сводками в логе, 0 - не печатать
+
+# Прием обновлений: вебхук вместо long polling
+WEBHOOK_URL = None  # публичный адрес за обратным прокси, например "https://example.com/telegram"; None - long polling
+WEBHOOK_HOST = "127.0.0.1"
+WEBHOOK_PORT = 8443
+WEBHOOK_PATH = "/telegram"
+WEBHOOK_SECRET = ""  # 1-256 символов A-Z, a-z, 0-9, _ и -
+WEBHOOK_DEDUPE_SIZE = 10000  # последних update_id для отсева повторов
+WEBHOOK_MAX_BODY = 1 << 20  # байт
+
+# Несколько процессов: игроки распределяются по шардам консистентным хешированием
+SHARD_WORKERS = 0  # процессов-шардов; 0 или 1 - все в одном процессе
+SHARD_VNODES = 64  # точек на кольце у каждого шарда
+SHARD_JOBS_DB = "shard_jobs.db"  # задания между шардами (передачи)
+SHARD_JOB_POLL_INTERVAL = 0.2  # секунд
+SHARD_LEADERBOARD_DB = "leaderboard.db"  # общий рейтинг: каждый шард публикует своих игроков
+
+# История игроков: журнал событий, отдельно от данных игрока
+HISTORY_DIR = "history"
+HISTORY_SEGMENT_BYTES = 64 * 1024  # размер сегмента журнала
+HISTORY_MAX_SEGMENTS = 8  # закрытых сегментов до слияния
+HISTORY_MAX_EVENTS = 5000  # событий игрока, которые остаются после слияния; None - все
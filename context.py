@@ -0,0 +1,88 @@
+import asyncio
+from contextlib import ExitStack
+from api import call_ai, AIError
+from config import SUMMARY_BATCH, SUMMARY_MAX_CHARS
+
+SUMMARY_PROMPT = """
+Ты ведешь краткую память игрока в игре о жизни.
+Тебе дано прежнее краткое содержание и новые реплики игрока и ведущего.
+Составь новое краткое содержание: важные события, договоренности, цели игрока.
+Не пиши баланс и инвентарь - они известны отдельно.
+Не больше 3-4 предложений, без вступлений.
+"""
+
+# Игроки, для которых сейчас обновляется краткое содержание
+_summarizing = set()
+_tasks = set()
+
+def estimate_tokens(text):
+    """Грубая оценка числа токенов без токенизатора: латиница ~4 символа
+    на токен, кириллица и прочее ~2 символа на токен"""
+    ascii_chars = len(text.encode('ascii', 'ignore'))
+    return ascii_chars // 4 + (len(text) - ascii_chars) // 2 + 1
+
+def message_tokens(message):
+    """Оценка токенов одного сообщения с учетом служебной разметки"""
+    return estimate_tokens(message["content"]) + 4
+
+def select_history(history, budget):
+    """Выбирает самые свежие реплики, которые помещаются в бюджет токенов"""
+    selected = []
+    used = 0
+    for message in reversed(history):
+        cost = message_tokens(message)
+        if used + cost > budget:
+            break
+        selected.append(message)
+        used += cost
+    selected.reverse()
+    return selected
+
+def age_out(user_data, messages):
+    """Откладывает вышедшие из окна реплики для краткого содержания"""
+    user_data.summary_pending.extend(
+        {"role": m["role"], "content": m["content"]} for m in messages
+    )
+
+async def refresh_summary(user_data, save_func):
+    """Сворачивает отложенные реплики в краткое содержание игрока"""
+    pending = list(user_data.summary_pending)
+    text = f"ПРЕЖНЕЕ СОДЕРЖАНИЕ:\n{user_data.summary or 'нет'}\n\nНОВЫЕ РЕПЛИКИ:\n"
+    text += "\n".join(f"{'Игрок' if m['role'] == 'user' else 'Ведущий'}: {m['content']}" for m in pending)
+
+    try:
+        summary = await call_ai([
+            {"role": "system", "content": SUMMARY_PROMPT},
+            {"role": "user", "content": text}
+        ], "summary", validate=lambda answer: bool(answer.strip()))
+    except AIError as e:
+        print(f"Ошибка обновления памяти игрока {user_data.user_id}: {e}")
+        return
+
+    user_data.summary = summary.strip()[:SUMMARY_MAX_CHARS]
+    # Пока шел запрос, могли появиться новые реплики - оставляем их
+    del user_data.summary_pending[:len(pending)]
+    save_func(user_data)
+
+def schedule_summary(user_data, save_func, pin_func):
+    """Запускает обновление краткого содержания в фоне, когда накопилось достаточно реплик.
+    pin_func(user_id) - контекст, удерживающий запись игрока в кэше до конца обновления"""
+    user_id = user_data.user_id
+    if len(user_data.summary_pending) < SUMMARY_BATCH or user_id in _summarizing:
+        return
+
+    # Запись закрепляется сразу: действие, запустившее обновление, может завершиться раньше задачи
+    pin = ExitStack()
+    pin.enter_context(pin_func(user_id))
+
+    async def run():
+        try:
+            with pin:
+                await refresh_summary(user_data, save_func)
+        finally:
+            _summarizing.discard(user_id)
+
+    _summarizing.add(user_id)
+    task = asyncio.get_running_loop().create_task(run())
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
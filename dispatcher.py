@@ -0,0 +1,249 @@
+import time
+import asyncio
+import itertools
+from telegram.error import RetryAfter
+from sharding import SHARD_COUNT
+from metrics import stage, stats_gauge, register, Gauge
+from config import TELEGRAM_GLOBAL_RATE, TELEGRAM_CHAT_RATE, TELEGRAM_CHAT_BURST, SEND_WORKERS
+
+# Очереди по приоритету: ответы игрокам идут раньше уведомлений и статусов
+PRIORITY_ANSWER = 0
+PRIORITY_NOTICE = 1
+PRIORITY_STATUS = 2
+
+class TokenBucket:
+    """Ограничитель частоты: rate операций в секунду, не больше burst подряд"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def available_in(self):
+        """Через сколько секунд можно выполнить операцию"""
+        now = time.monotonic()
+        self._refill(now)
+        wait = max(0, self.blocked_until - now)
+        if self.tokens < 1:
+            wait = max(wait, (1 - self.tokens) / self.rate)
+        return wait
+
+    def consume(self):
+        self.tokens -= 1
+
+    def block(self, seconds):
+        """Запрещает операции на время (ответ 429 от Telegram)"""
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    def idle(self):
+        self._refill(time.monotonic())
+        return self.tokens >= self.burst and self.blocked_until <= time.monotonic()
+
+class Job:
+    """Вызов Bot API в очереди отправки"""
+
+    def __init__(self, method, chat_id, priority, **kwargs):
+        self.method = method
+        self.chat_id = chat_id
+        self.priority = priority
+        self.kwargs = kwargs
+        self.started = False
+        self.replaced = False
+        self.after = None
+        self.enqueued = time.monotonic()
+        self.future = asyncio.get_running_loop().create_future()
+        self.future.add_done_callback(_retrieve)
+
+    def prepare(self):
+        """Возвращает метод бота и аргументы вызова"""
+        return self.method, dict(self.kwargs, chat_id=self.chat_id)
+
+    def done(self, result):
+        pass
+
+class StatusJob(Job):
+    """Отправка или правка статусного сообщения: что именно - решается при выполнении"""
+
+    def __init__(self, status, text, priority):
+        super().__init__(None, status.chat_id, priority, text=text)
+        self.status = status
+
+    def prepare(self):
+        kwargs = dict(self.kwargs, chat_id=self.chat_id)
+        if self.status.message is None:
+            if self.status.reply_to_message_id:
+                kwargs["reply_to_message_id"] = self.status.reply_to_message_id
+            return "send_message", kwargs
+        kwargs["message_id"] = self.status.message.message_id
+        return "edit_message_text", kwargs
+
+    def done(self, result):
+        if self.status.message is None:
+            self.status.message = result
+
+def _retrieve(future):
+    # Ошибки отправок без ожидающих не должны попадать в лог как необработанные
+    if not future.cancelled():
+        future.exception()
+
+class StatusMessage:
+    """Одно сообщение на действие игрока: "в очереди" -> "думаю" -> ответ.
+    Каждое новое состояние - правка того же сообщения; если предыдущая правка
+    еще не отправлена, вместо новой операции просто меняется ее текст"""
+
+    def __init__(self, dispatcher, chat_id, reply_to_message_id=None):
+        self.dispatcher = dispatcher
+        self.chat_id = chat_id
+        self.reply_to_message_id = reply_to_message_id
+        self.message = None
+        self._job = None
+
+    def set(self, text, priority=PRIORITY_STATUS):
+        """Меняет текст сообщения. Возвращает Future с результатом отправки"""
+        job = self._job
+        new_job = StatusJob(self, text, priority)
+        if job is not None and not job.started and not job.replaced:
+            self.dispatcher.stats["coalesced"] += 1
+            if priority >= job.priority:
+                job.kwargs["text"] = text
+                return job.future
+            # Более срочный текст заменяет еще не отправленный
+            job.replaced = True
+            new_job.future.add_done_callback(lambda f: _chain(f, job.future))
+            new_job.after = job.after
+        elif job is not None and not job.future.done():
+            # Предыдущая операция выполняется: сообщение, возможно, еще не создано
+            new_job.after = job.future
+
+        self._job = new_job
+        if new_job.after is not None and not new_job.after.done():
+            new_job.after.add_done_callback(lambda _: self.dispatcher.enqueue(new_job))
+        else:
+            self.dispatcher.enqueue(new_job)
+        return new_job.future
+
+def _chain(source, target):
+    if target.done():
+        return
+    if source.cancelled():
+        target.cancel()
+    elif source.exception() is not None:
+        target.set_exception(source.exception())
+    else:
+        target.set_result(source.result())
+
+class Dispatcher:
+    """Очередь исходящих вызовов Telegram с ограничением частоты
+    (общий лимит и лимит на чат), приоритетами и повтором после 429"""
+
+    def __init__(self, global_rate=30, chat_rate=1, chat_burst=3, workers=8):
+        self.bot = None
+        self.workers = workers
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.chat_buckets = {}
+        self._queue = None
+        self._seq = itertools.count()
+        self.stats = {
+            "sent": 0, "errors": 0, "throttled": 0, "retry_after": 0, "coalesced": 0,
+            "send_time_total": 0.0, "queue_wait_total": 0.0
+        }
+
+    def start(self, application):
+        """Запускает воркеры отправки"""
+        self.bot = application.bot
+        self._queue = asyncio.PriorityQueue()
+        for _ in range(self.workers):
+            application.create_task(self._worker())
+
+    def enqueue(self, job):
+        self._queue.put_nowait((job.priority, next(self._seq), job))
+
+    def submit(self, method, chat_id, priority=PRIORITY_ANSWER, **kwargs):
+        """Ставит вызов метода бота в очередь. Возвращает Future с результатом"""
+        job = Job(method, chat_id, priority, **kwargs)
+        self.enqueue(job)
+        return job.future
+
+    def send_message(self, chat_id, text, priority=PRIORITY_ANSWER, **kwargs):
+        return self.submit("send_message", chat_id, priority, text=text, **kwargs)
+
+    def edit_message_text(self, chat_id, message_id, text, priority=PRIORITY_ANSWER, **kwargs):
+        return self.submit("edit_message_text", chat_id, priority, message_id=message_id, text=text, **kwargs)
+
+    def status(self, chat_id, reply_to_message_id=None):
+        """Создает статусное сообщение для действия игрока"""
+        return StatusMessage(self, chat_id, reply_to_message_id)
+
+    def _chat_bucket(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) > 10000:
+                self.chat_buckets = {k: b for k, b in self.chat_buckets.items() if not b.idle()}
+            bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await self._queue.get()
+            job = item[2]
+            if job.replaced or job.future.done():
+                continue
+
+            # Чат упирается в свой лимит - откладываем, не задерживая другие чаты
+            chat_bucket = self._chat_bucket(job.chat_id)
+            wait = chat_bucket.available_in()
+            if wait > 0:
+                self.stats["throttled"] += 1
+                loop.call_later(wait, self._queue.put_nowait, item)
+                continue
+            wait = self.global_bucket.available_in()
+            if wait > 0:
+                self.stats["throttled"] += 1
+                await asyncio.sleep(wait)
+                self._queue.put_nowait(item)
+                continue
+            chat_bucket.consume()
+            self.global_bucket.consume()
+
+            job.started = True
+            self.stats["queue_wait_total"] += time.monotonic() - job.enqueued
+            method, kwargs = job.prepare()
+            started = time.monotonic()
+            try:
+                with stage("send"):
+                    result = await getattr(self.bot, method)(**kwargs)
+            except RetryAfter as e:
+                self.stats["retry_after"] += 1
+                retry_after = e.retry_after
+                if hasattr(retry_after, "total_seconds"):
+                    retry_after = retry_after.total_seconds()
+                chat_bucket.block(retry_after)
+                job.started = False
+                loop.call_later(retry_after, self._queue.put_nowait, item)
+                continue
+            except Exception as e:
+                self.stats["errors"] += 1
+                print(f"Ошибка отправки в чат {job.chat_id}: {e}")
+                job.future.set_exception(e)
+                continue
+            finally:
+                self.stats["send_time_total"] += time.monotonic() - started
+
+            self.stats["sent"] += 1
+            job.done(result)
+            job.future.set_result(result)
+
+# Общий лимит Telegram делится между процессами-шардами
+dispatcher = Dispatcher(TELEGRAM_GLOBAL_RATE / SHARD_COUNT, TELEGRAM_CHAT_RATE, TELEGRAM_CHAT_BURST, SEND_WORKERS)
+stats_gauge("lifesim_telegram", "Отправка в Telegram: вызовы, ошибки, ожидания лимитов, 429", dispatcher.stats, "kind")
+register(Gauge("lifesim_telegram_queue_depth", "Вызовов Telegram в очереди",
+               lambda: [({}, dispatcher._queue.qsize() if dispatcher._queue else 0)]))
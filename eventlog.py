@@ -0,0 +1,129 @@
+import os
+import json
+import threading
+
+class EventLog:
+    """Журнал событий игроков: каталог на игрока, события - строки JSON в сегментах.
+
+    Событие дописывается одним вызовом write в файл, открытый с O_APPEND, поэтому
+    запись не читает и не переписывает прежнюю историю. Сегмент, выросший больше
+    segment_bytes, закрывается и начинается следующий; когда закрытых сегментов
+    становится больше max_segments, они сливаются в один, а события сверх
+    max_events (самые старые) отбрасываются.
+    """
+
+    def __init__(self, directory, segment_bytes=64 * 1024, max_segments=8, max_events=None):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_segments = max_segments
+        self.max_events = max_events
+        self._lock = threading.Lock()
+        self._active = {}  # ID игрока -> номер текущего сегмента
+        os.makedirs(directory, exist_ok=True)
+
+    def _user_dir(self, user_id):
+        return os.path.join(self.directory, str(user_id))
+
+    def _segment_path(self, user_id, number):
+        return os.path.join(self._user_dir(user_id), f"{number:06d}.log")
+
+    def _segments(self, user_id):
+        try:
+            names = os.listdir(self._user_dir(user_id))
+        except FileNotFoundError:
+            return []
+        return sorted(int(name[:-4]) for name in names if name.endswith(".log") and name[:-4].isdigit())
+
+    def _open_segment(self, user_id):
+        """Номер текущего сегмента; при первом обращении проверяет оборванную последнюю строку"""
+        number = self._active.get(user_id)
+        if number is not None:
+            return number, b""
+        segments = self._segments(user_id)
+        number = segments[-1] if segments else 1
+        os.makedirs(self._user_dir(user_id), exist_ok=True)
+        if len(self._active) >= 100000:
+            self._active.clear()
+        self._active[user_id] = number
+
+        # Запись, прерванная сбоем, не должна склеиться со следующим событием
+        try:
+            with open(self._segment_path(user_id, number), "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                return number, b"" if f.read(1) == b"\n" else b"\n"
+        except (FileNotFoundError, OSError):
+            return number, b""
+
+    def append(self, user_id, event):
+        """Дописывает событие игрока"""
+        self.extend(user_id, [event])
+
+    def extend(self, user_id, events):
+        """Дописывает несколько событий одной записью"""
+        if not events:
+            return
+        data = "".join(json.dumps(event, ensure_ascii=False, separators=(",", ":")) + "\n" for event in events)
+        with self._lock:
+            number, prefix = self._open_segment(user_id)
+            fd = os.open(self._segment_path(user_id, number), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, prefix + data.encode())
+                size = os.fstat(fd).st_size
+            finally:
+                os.close(fd)
+            if size >= self.segment_bytes:
+                self._active[user_id] = number + 1
+                if len(self._segments(user_id)) > self.max_segments:
+                    self._compact(user_id)
+
+    def _read_segment(self, user_id, number):
+        events = []
+        try:
+            with open(self._segment_path(user_id, number), "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        events.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        # Оборванная сбоем запись
+                        continue
+        except FileNotFoundError:
+            pass
+        return events
+
+    def _compact(self, user_id):
+        """Сливает закрытые сегменты в один (вызывать под блокировкой)"""
+        active = self._active.get(user_id)
+        sealed = [number for number in self._segments(user_id) if number != active]
+        if len(sealed) < 2:
+            return
+        events = []
+        for number in sealed:
+            events.extend(self._read_segment(user_id, number))
+        if self.max_events is not None:
+            events = events[-self.max_events:]
+
+        target = self._segment_path(user_id, sealed[0])
+        tmp = f"{target}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            for event in events:
+                f.write(json.dumps(event, ensure_ascii=False, separators=(",", ":")) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, target)
+        for number in sealed[1:]:
+            os.remove(self._segment_path(user_id, number))
+
+    def compact(self, user_id):
+        """Сливает закрытые сегменты игрока"""
+        with self._lock:
+            self._compact(user_id)
+
+    def read(self, user_id, offset=0, limit=20):
+        """Страница истории игрока: события от новых к старым"""
+        needed = offset + limit
+        events = []
+        for number in reversed(self._segments(user_id)):
+            events.extend(reversed(self._read_segment(user_id, number)))
+            if len(events) >= needed:
+                break
+        return events[offset:needed]
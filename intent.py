@@ -0,0 +1,115 @@
+import re
+from metrics import stats_gauge
+
+# Намерения сообщения игрока
+INTENT_TRANSFER = "transfer"
+INTENT_ACTION = "action"
+INTENT_BALANCE = "balance"
+INTENT_INVENTORY = "inventory"
+
+TRANSFER_THRESHOLD = 3.0
+QUERY_THRESHOLD = 3.0
+
+TOKEN_RE = re.compile(r"\d+|[^\W\d_]+")
+CURRENCY_RE = re.compile(r"\d+\s*(?:\$|доллар|бакс)|\$\s*\d+", re.I)
+
+def word_forms(stems, endings):
+    """Формы слова: каждая основа с каждым окончанием.
+    Сравниваются целые слова, поэтому лишние сочетания ничему не мешают"""
+    return {stem + ending for stem in stems for ending in endings}
+
+# Глаголы передачи. Слова сравниваются целиком: "продать" и "задать" не совпадают с "дать"
+TRANSFER_VERBS = (
+    word_forms(("переда", "отда", "да"), ("ть", "м", "ю", "й", "йте", "л", "ла", "ешь", "ет")) |
+    word_forms(("передад", "отдад", "дад"), ("им", "ите", "ут")) |
+    word_forms(("кин", "скин"), ("уть", "у", "ь", "ьте", "ул", "ула", "ем")) |
+    word_forms(("кида", "скида"), ("ть", "ю", "ем", "й")) |
+    word_forms(("перевед",), ("и", "у", "ите", "ем")) | {"перевести", "перевожу", "перевел", "перевела"} |
+    word_forms(("подар",), ("ить", "ю", "и", "ите", "ил", "ила"))
+)
+RECEIVER_WORDS = {"игроку", "игрок", "пользователю", "юзеру", "получателю", "id", "айди", "ид"}
+MESSAGE_WORDS = {"сообщением", "сообщение", "запиской", "подписью", "текстом"}
+
+BALANCE_WORDS = (
+    word_forms(("баланс",), ("", "а", "е", "у")) |
+    word_forms(("деньг", "бабк"), ("и", "ах", "ами")) | {"денег", "бабок"} |
+    word_forms(("сч",), ("ет", "ете", "ету", "ета")) | {"сбережения", "сбережений", "накопления"}
+)
+INVENTORY_WORDS = (
+    word_forms(("инвентар",), ("ь", "я", "е", "ю")) |
+    word_forms(("вещ",), ("и", "ей", "ах")) |
+    word_forms(("предмет",), ("ы", "ов", "ах")) |
+    word_forms(("рюкзак",), ("", "е", "а")) | {"сумке", "карманах", "имущество"}
+)
+QUERY_WORDS = {
+    "сколько", "какой", "какая", "какие", "какое", "каков", "что", "покажи", "показать", "проверь",
+    "проверить", "посмотреть", "посмотри", "глянуть", "узнать", "мой", "моя", "мои", "мое"
+}
+# Слова, по которым вопрос о деньгах или вещах - это игровое действие, а не справка
+PURPOSE_WORDS = {
+    "чтобы", "если", "хватит", "хватает", "купить", "куплю", "продать", "продам", "потратить",
+    "потрачу", "заработать", "заработаю", "заработал", "взять", "беру", "украсть", "найти"
+}
+
+# Счетчики распознанных намерений
+intent_stats = {INTENT_TRANSFER: 0, INTENT_ACTION: 0, INTENT_BALANCE: 0, INTENT_INVENTORY: 0}
+stats_gauge("lifesim_intents", "Сообщения игроков по распознанному намерению", intent_stats, "intent")
+
+def tokenize(text):
+    return TOKEN_RE.findall(text.lower().replace("ё", "е"))
+
+def transfer_score(text, tokens):
+    """Оценка того, что сообщение - команда передачи.
+    Без глагола передачи оценка нулевая: "продам машину игроку 123456" - игровое действие"""
+    if not any(token in TRANSFER_VERBS for token in tokens):
+        return 0.0
+    score = 2.0
+    if any(token in RECEIVER_WORDS and nxt.isdigit() and len(nxt) >= 3 for token, nxt in zip(tokens, tokens[1:])):
+        score += 2.5
+    if any(token.isdigit() and len(token) >= 5 for token in tokens):
+        score += 1.0
+    if CURRENCY_RE.search(text):
+        score += 0.5
+    if any(token in MESSAGE_WORDS for token in tokens):
+        score += 0.5
+    return score
+
+def query_score(text, tokens, topic_words):
+    """Оценка того, что сообщение - вопрос о балансе или инвентаре"""
+    if not any(token in topic_words for token in tokens):
+        return 0.0
+    score = 2.0
+    if text.rstrip().endswith("?") or any(token in QUERY_WORDS for token in tokens):
+        score += 1.5
+    if len(tokens) <= 2:
+        score += 1.0
+    elif len(tokens) > 7:
+        score -= 2.0
+    if any(token in PURPOSE_WORDS for token in tokens):
+        score -= 2.0
+    return score
+
+def score_intents(text):
+    """Оценки всех намерений сообщения"""
+    tokens = tokenize(text)
+    inventory = query_score(text, tokens, INVENTORY_WORDS)
+    if "что" in tokens and "есть" in tokens and "меня" in tokens:
+        # "что у меня есть?" - вопрос об инвентаре без слова "инвентарь"
+        inventory = max(inventory, query_score(text, tokens, {"есть"}))
+    return {
+        INTENT_TRANSFER: transfer_score(text, tokens),
+        INTENT_BALANCE: query_score(text, tokens, BALANCE_WORDS),
+        INTENT_INVENTORY: inventory,
+    }
+
+def classify(text):
+    """Намерение сообщения: передача, справка о балансе или инвентаре, иначе игровое действие"""
+    scores = score_intents(text)
+    if scores[INTENT_TRANSFER] >= TRANSFER_THRESHOLD:
+        intent = INTENT_TRANSFER
+    else:
+        intent = max((INTENT_BALANCE, INTENT_INVENTORY), key=scores.get)
+        if scores[intent] < QUERY_THRESHOLD:
+            intent = INTENT_ACTION
+    intent_stats[intent] += 1
+    return intent
@@ -0,0 +1,177 @@
+import os
+import json
+import bisect
+import sqlite3
+import threading
+
+class Leaderboard:
+    """Рейтинг игроков по балансу, обновляемый при каждом сохранении.
+    Обновляется и из потоков работы с диском, поэтому защищен блокировкой"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._keys = []  # отсортированный список (-баланс, user_id)
+        self._entries = {}  # user_id -> (баланс, юзернейм, имя)
+
+    def update(self, user_id, balance, username="", first_name=""):
+        """Добавляет игрока или обновляет его баланс"""
+        user_id = int(user_id)
+        with self._lock:
+            old = self._entries.get(user_id)
+            if old is None or old[0] != balance:
+                if old is not None:
+                    index = bisect.bisect_left(self._keys, (-old[0], user_id))
+                    del self._keys[index]
+                bisect.insort(self._keys, (-balance, user_id))
+            self._entries[user_id] = (balance, username or "", first_name or "")
+
+    def top(self, k):
+        """Возвращает первых k игроков: (user_id, баланс, юзернейм, имя)"""
+        with self._lock:
+            return [(user_id, *self._entries[user_id]) for _, user_id in self._keys[:k]]
+
+    def rank(self, user_id):
+        """Возвращает место игрока в рейтинге (None если игрока нет)"""
+        entry = self.get(user_id)
+        if entry is None:
+            return None
+        return self.ahead(entry[0], user_id) + 1
+
+    def get(self, user_id):
+        """Запись игрока (баланс, юзернейм, имя) или None"""
+        with self._lock:
+            return self._entries.get(int(user_id))
+
+    def ahead(self, balance, user_id):
+        """Сколько игроков стоит в рейтинге выше игрока с таким балансом"""
+        with self._lock:
+            return bisect.bisect_left(self._keys, (-balance, int(user_id)))
+
+    def build(self, users):
+        """Строит рейтинг по списку игроков (чтение списка идет без блокировки)"""
+        self._replace({u.user_id: (u.balance, u.username, u.first_name) for u in users})
+
+    def _replace(self, entries):
+        keys = sorted((-entry[0], user_id) for user_id, entry in entries.items())
+        with self._lock:
+            self._entries, self._keys = entries, keys
+
+    def save(self, path):
+        """Сохраняет снимок рейтинга"""
+        with self._lock:
+            entries = [[user_id, *entry] for user_id, entry in self._entries.items()]
+        tmp_file = f"{path}.tmp"
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(entries, f, ensure_ascii=False)
+        os.replace(tmp_file, path)
+
+    def load(self, path):
+        """Загружает снимок рейтинга. Снимок удаляется, чтобы после сбоя рейтинг
+        был перестроен по хранилищу, а не по устаревшему снимку"""
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                entries = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return False
+        os.remove(path)
+        self._replace({user_id: (balance, username, first_name) for user_id, balance, username, first_name in entries})
+        return True
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class ShardedLeaderboard:
+    """Рейтинг для нескольких процессов-шардов.
+
+    Каждый шард держит в памяти рейтинг своих игроков (local) и публикует изменения
+    в общую таблицу SQLite (publish). Топ, место и число игроков собираются из своего
+    рейтинга и опубликованных записей других шардов, поэтому игроки других шардов
+    видны с задержкой не больше интервала публикации."""
+
+    def __init__(self, path, shard, local=None):
+        self.shard = shard
+        self.local = local or Leaderboard()
+        self._lock = threading.Lock()
+        self._changed = set()  # игроки, изменившиеся после последней публикации
+        self.conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript("""
+        CREATE TABLE IF NOT EXISTS leaderboard (
+            user_id INTEGER PRIMARY KEY,
+            shard INTEGER NOT NULL,
+            balance INTEGER NOT NULL,
+            username TEXT NOT NULL,
+            first_name TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS leaderboard_balance ON leaderboard(balance DESC, user_id);
+        """)
+
+    def update(self, user_id, balance, username="", first_name=""):
+        self.local.update(user_id, balance, username, first_name)
+        with self._lock:
+            self._changed.add(int(user_id))
+
+    def publish(self):
+        """Записывает изменения своих игроков в общую таблицу"""
+        with self._lock:
+            changed, self._changed = self._changed, set()
+        rows = []
+        for user_id in changed:
+            entry = self.local.get(user_id)
+            if entry is not None:
+                rows.append((user_id, self.shard, *entry))
+        if not rows:
+            return
+        with self._lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO leaderboard (user_id, shard, balance, username, first_name) "
+                "VALUES (?, ?, ?, ?, ?)", rows
+            )
+
+    def top(self, k):
+        with self._lock:
+            others = self.conn.execute(
+                "SELECT user_id, balance, username, first_name FROM leaderboard "
+                "WHERE shard != ? ORDER BY balance DESC, user_id LIMIT ?", (self.shard, k)
+            ).fetchall()
+        return sorted(self.local.top(k) + others, key=lambda row: (-row[1], row[0]))[:k]
+
+    def rank(self, user_id):
+        user_id = int(user_id)
+        entry = self.local.get(user_id)
+        with self._lock:
+            if entry is None:
+                entry = self.conn.execute("SELECT balance FROM leaderboard WHERE user_id = ?", (user_id,)).fetchone()
+                if entry is None:
+                    return None
+            balance = entry[0]
+            (others,) = self.conn.execute(
+                "SELECT COUNT(*) FROM leaderboard WHERE shard != ? AND (balance > ? OR (balance = ? AND user_id < ?))",
+                (self.shard, balance, balance, user_id)
+            ).fetchone()
+        return self.local.ahead(balance, user_id) + others + 1
+
+    def build(self, users):
+        """Строит рейтинг своих игроков; при публикации они перезапишутся целиком"""
+        self.local.build(users)
+        self._changed_all()
+
+    def save(self, path):
+        self.publish()
+        self.local.save(path)
+
+    def load(self, path):
+        if not self.local.load(path):
+            return False
+        self._changed_all()
+        return True
+
+    def _changed_all(self):
+        with self._lock:
+            self._changed = {user_id for user_id, *_ in self.local.top(len(self.local))}
+
+    def __len__(self):
+        with self._lock:
+            (others,) = self.conn.execute("SELECT COUNT(*) FROM leaderboard WHERE shard != ?", (self.shard,)).fetchone()
+        return len(self.local) + others
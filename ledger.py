@@ -0,0 +1,108 @@
+import os
+import json
+import threading
+from contextlib import contextmanager
+
+class TransferLedger:
+    """Атомарное применение передач: блокировки по игрокам и журнал упреждающей записи.
+
+    Перед изменением игроков в журнал пишутся их итоговые данные, после записи
+    на диск - отметка о завершении. Незавершенные записи применяются повторно
+    при запуске, поэтому сбой между сохранениями не создает и не уничтожает деньги.
+
+    Живые данные игроков меняются только после записи на диск. Если запись не
+    удалась, на диск возвращаются живые данные участников (restore_func) и в журнал
+    пишется отметка об отмене: при запуске такая передача не применяется.
+    Неудавшийся откат повторяется перед следующими передачами.
+    """
+
+    def __init__(self, journal_path, write_func, restore_func, stripes=64, max_journal_bytes=1024 * 1024):
+        self.journal_path = journal_path
+        self.write_func = write_func
+        self.restore_func = restore_func
+        self.max_journal_bytes = max_journal_bytes
+        self._stripes = [threading.Lock() for _ in range(stripes)]
+        self._journal_lock = threading.Lock()
+        self._open = 0
+        self._unresolved = {}  # ID передачи -> ID участников, чей откат еще не удался
+
+    @contextmanager
+    def lock_users(self, *user_ids):
+        """Блокирует игроков; блокировки берутся всегда в одном порядке"""
+        indexes = sorted({hash(int(user_id)) % len(self._stripes) for user_id in user_ids})
+        for index in indexes:
+            self._stripes[index].acquire()
+        try:
+            yield
+        finally:
+            for index in reversed(indexes):
+                self._stripes[index].release()
+
+    def _append(self, entry):
+        with open(self.journal_path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def commit(self, transfer_id, records):
+        """Атомарно записывает итоговые данные игроков (вызывать под lock_users)"""
+        self.resolve()
+        with self._journal_lock:
+            self._append({"id": transfer_id, "state": "begin", "records": records})
+            self._open += 1
+        try:
+            self.write_func(records)
+        except Exception:
+            with self._journal_lock:
+                self._open -= 1
+                self._unresolved[transfer_id] = [record["user_id"] for record in records]
+            self.resolve()
+            raise
+        with self._journal_lock:
+            self._append({"id": transfer_id, "state": "commit"})
+            self._open -= 1
+            self._compact()
+
+    def resolve(self):
+        """Откатывает неудавшиеся передачи: записывает живые данные участников и
+        отмечает отмену в журнале. Пока откат не удался, передача остается незавершенной"""
+        with self._journal_lock:
+            unresolved = list(self._unresolved.items())
+        for transfer_id, user_ids in unresolved:
+            try:
+                self.restore_func(user_ids)
+            except Exception as e:
+                print(f"Не удалось откатить передачу {transfer_id}: {e}")
+                continue
+            with self._journal_lock:
+                self._append({"id": transfer_id, "state": "abort"})
+                del self._unresolved[transfer_id]
+
+    def _compact(self):
+        # Журнал можно очистить, когда нет незавершенных и неоткаченных передач
+        if self._open == 0 and not self._unresolved and os.path.getsize(self.journal_path) > self.max_journal_bytes:
+            os.remove(self.journal_path)
+
+    def replay(self):
+        """Повторно применяет незавершенные передачи после сбоя"""
+        pending = {}
+        try:
+            with open(self.journal_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # Оборванная последняя строка: передача не начиналась
+                        continue
+                    if entry["state"] == "begin":
+                        pending[entry["id"]] = entry["records"]
+                    else:
+                        # commit - записано, abort - отменено и откачено
+                        pending.pop(entry["id"], None)
+        except FileNotFoundError:
+            return 0
+
+        for records in pending.values():
+            self.write_func(records)
+        os.remove(self.journal_path)
+        return len(pending)
@@ -1,50 +1,258 @@
+import time
 import asyncio
-import threading
 from collections import deque
+from itertools import count
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes, CallbackQueryHandler
+from telegram.error import TelegramError
 
-from config import TELEGRAM_TOKEN
-from prompt import load_user_data, process_user_action, get_inventory_count
-from transfer import parse_transfer_command, create_transfer, execute_transfer, pending_transfers
+from config import (TELEGRAM_TOKEN, AI_WORKERS, CACHE_FLUSH_INTERVAL, INVENTORY_SLOTS, STREAMING,
+                    PENDING_EXPIRY_INTERVAL, METRICS_HOST, METRICS_PORT, METRICS_LOG_INTERVAL, WEBHOOK_URL,
+                    SHARD_WORKERS, SHARD_JOB_POLL_INTERVAL, MAX_USER_ACTIONS, MAX_QUEUED_ACTIONS,
+                    ACTION_COALESCE_WINDOW, MAX_COALESCED_MESSAGES, QUEUE_POSITION_INTERVAL)
+from api import AIError, close_client
+from dispatcher import dispatcher, PRIORITY_ANSWER, PRIORITY_NOTICE
+from prompt import (get_user, get_or_create_user, active_user, run_io, flush_due, process_user_action,
+                    flush_user_data, close_user_data, init_leaderboard, publish_leaderboard, leaderboard)
+from transfer import (parse_transfer_command, create_transfer, execute_transfer, recover_transfers, expire_transfers,
+                      apply_transfer_step, pending_transfers, TRANSFER_NOT_FOUND)
+from sharding import SHARD_INDEX, SHARD_COUNT, shard_jobs, start_shards, run_shard_process
+from intent import classify, INTENT_TRANSFER, INTENT_BALANCE, INTENT_INVENTORY
+from webhook import run_webhook
+from metrics import register, Gauge, QUEUE_WAIT_SECONDS, start_http_server, log_summary_loop, stats_gauge
 from datetime import datetime
-import os
-import json
-# Очередь для обработки запросов
-request_queue = deque()
-processing_lock = threading.Lock()
+# Очередь для обработки запросов: ID игроков, у которых есть необработанные действия.
+# Игрок находится в очереди не более одного раза, поэтому его действия
+# выполняются строго по порядку, а разные игроки обрабатываются параллельно.
+request_queue = None
+user_actions = {}  # ID игрока -> ожидающие действия
+running_users = set()  # игроки, чье действие сейчас выполняется
+waiting_actions = {}  # номер действия -> действие, в порядке постановки в очередь
+action_numbers = count()
+register(Gauge("lifesim_action_queue_depth", "Действий игроков в очереди", lambda: [({}, len(waiting_actions))]))
 
-# Создаем папку users
-os.makedirs("users", exist_ok=True)
+# Итоги приема действий в очередь
+ADMIT_QUEUED = "queued"
+ADMIT_COALESCED = "coalesced"
+ADMIT_USER_LIMIT = "user_limit"
+ADMIT_OVERLOAD = "overload"
+admission_stats = {ADMIT_QUEUED: 0, ADMIT_COALESCED: 0, ADMIT_USER_LIMIT: 0, ADMIT_OVERLOAD: 0}
+stats_gauge("lifesim_action_admission", "Сообщения-действия по итогу приема в очередь", admission_stats, "result")
 
-async def process_queue():
-    """Обрабатывает очередь запросов"""
+NOT_STARTED_TEXT = "❌ Вы еще не начали игру. Отправьте /start"
+REJECT_TEXTS = {
+    ADMIT_USER_LIMIT: "⏳ Дождитесь ответа на предыдущие действия, прежде чем отправлять новые",
+    ADMIT_OVERLOAD: "🚦 Сейчас слишком много игроков. Попробуйте через минуту",
+}
+
+class QueuedAction:
+    """Действие игрока в очереди. Сообщения, пришедшие подряд, дописываются к нему,
+    пока оно ожидает: ИИ получает их одним действием"""
+
+    __slots__ = ("number", "update", "context", "texts", "status", "enqueued_at", "updated_at", "position")
+
+    def __init__(self, update, context, text, status, position):
+        self.number = next(action_numbers)
+        self.update = update
+        self.context = context
+        self.texts = [text]
+        self.status = status
+        self.enqueued_at = self.updated_at = time.monotonic()
+        self.position = position
+
+    def queued_text(self):
+        text = f"⏳ Ваш запрос в очереди, позиция: {self.position}"
+        if len(self.texts) > 1:
+            text += f"\nОбъединено сообщений: {len(self.texts)}"
+        return text
+
+def enqueue_action(update, context, user_input):
+    """Принимает действие игрока в очередь. Возвращает итог приема (ADMIT_*).
+
+    Сообщение, пришедшее вскоре после предыдущего, дописывается к ожидающему действию.
+    Действий одного игрока не больше MAX_USER_ACTIONS, ожидающих действий всех игроков -
+    не больше MAX_QUEUED_ACTIONS: сверх лимита действие отклоняется сразу, а не ждет в очереди"""
+    user_id = update.effective_user.id
+    actions = user_actions.get(user_id)
+    if actions:
+        last = actions[-1]
+        now = time.monotonic()
+        if now - last.updated_at <= ACTION_COALESCE_WINDOW and len(last.texts) < MAX_COALESCED_MESSAGES:
+            last.texts.append(user_input)
+            last.updated_at = now
+            last.status.set(last.queued_text())
+            admission_stats[ADMIT_COALESCED] += 1
+            return ADMIT_COALESCED
+
+    if (len(actions) if actions else 0) + (user_id in running_users) >= MAX_USER_ACTIONS:
+        result = ADMIT_USER_LIMIT
+    elif len(waiting_actions) >= MAX_QUEUED_ACTIONS:
+        result = ADMIT_OVERLOAD
+    else:
+        status = dispatcher.status(update.effective_chat.id, update.message.message_id)
+        action = QueuedAction(update, context, user_input, status, len(waiting_actions) + 1)
+        waiting_actions[action.number] = action
+        if actions is None:
+            actions = user_actions[user_id] = deque()
+            request_queue.put_nowait(user_id)
+        actions.append(action)
+        status.set(action.queued_text())
+        result = ADMIT_QUEUED
+    admission_stats[result] += 1
+    return result
+
+def reply(update, text, **kwargs):
+    """Отвечает игроку через очередь отправки"""
+    return dispatcher.send_message(update.effective_chat.id, text, PRIORITY_ANSWER, **kwargs)
+
+def edit_reply(query, text):
+    """Заменяет текст сообщения с кнопками через очередь отправки"""
+    return dispatcher.edit_message_text(query.message.chat_id, query.message.message_id, text, PRIORITY_ANSWER)
+
+async def process_action(update, context, user_input, status):
+    """Обрабатывает одно действие игрока"""
+    status.set("🤔 Думаю над вашим предложением...")
+    
+    # Данные игрока берутся перед обработкой, а не при постановке в очередь:
+    # пока действие ждало, их могли изменить передачи или предыдущие действия
+    user = update.effective_user
+    async with active_user(user.id, user.username, user.first_name) as user_data:
+        # Обрабатываем действие через ИИ
+        if STREAMING:
+            async def show_progress(text):
+                """Показывает уже сгенерированную часть ответа"""
+                status.set(f"📊 {text[:4000]} ▌")
+            
+            response_text = await process_user_action(user_input, user_data, show_progress)
+        else:
+            response_text = await process_user_action(user_input, user_data)
+    
+    try:
+        await status.set(response_text, PRIORITY_ANSWER)
+    except TelegramError:
+        await reply(update, response_text)
+
+async def ai_worker():
+    """Воркер очереди запросов"""
     while True:
-        if request_queue:
-            with processing_lock:
-                if request_queue:
-                    update, context, user_input, user_data = request_queue.popleft()
-                    
-                    processing_msg = await update.message.reply_text("🤔 Думаю над вашим предложением...")
-                    
-                    # Обрабатываем действие через ИИ
-                    response_text = process_user_action(user_input, user_data)
-                    
-                    await processing_msg.delete()
-                    await update.message.reply_text(response_text)
-        
-        await asyncio.sleep(1)
+        user_id = await request_queue.get()
+        actions = user_actions[user_id]
+        action = actions.popleft()
+        del waiting_actions[action.number]
+        running_users.add(user_id)
+        QUEUE_WAIT_SECONDS.observe(time.monotonic() - action.enqueued_at)
+        try:
+            await process_action(action.update, action.context, "\n".join(action.texts), action.status)
+        except Exception as e:
+            print(f"Ошибка обработки действия игрока {user_id}: {e}")
+        finally:
+            running_users.discard(user_id)
+            if actions:
+                request_queue.put_nowait(user_id)
+            else:
+                del user_actions[user_id]
+            request_queue.task_done()
+
+async def queue_position_loop():
+    """Раз в QUEUE_POSITION_INTERVAL секунд показывает игрокам, сдвинулись ли их действия в очереди"""
+    while True:
+        await asyncio.sleep(QUEUE_POSITION_INTERVAL)
+        for position, action in enumerate(waiting_actions.values(), 1):
+            if position != action.position:
+                action.position = position
+                action.status.set(action.queued_text())
+
+async def flush_loop():
+    """Сбрасывает кэш игроков на диск раз в CACHE_FLUSH_INTERVAL секунд или раньше,
+    если изменений накопилось много. Запись идет в потоке работы с диском"""
+    last_flush = time.monotonic()
+    while True:
+        await asyncio.sleep(min(CACHE_FLUSH_INTERVAL, 0.5))
+        if flush_due() or time.monotonic() - last_flush >= CACHE_FLUSH_INTERVAL:
+            await run_io(flush_user_data)
+            await run_io(publish_leaderboard)
+            last_flush = time.monotonic()
+
+async def expire_loop():
+    """Удаляет просроченные передачи и уведомляет отправителей"""
+    while True:
+        await asyncio.sleep(PENDING_EXPIRY_INTERVAL)
+        for transfer in await run_io(expire_transfers):
+            dispatcher.send_message(
+                transfer["sender_id"],
+                f"⌛ Игрок (ID: {transfer['receiver_id']}) не ответил на вашу передачу, она отменена",
+                PRIORITY_NOTICE
+            )
+
+def accepted_notice(transfer):
+    """Уведомление отправителю о принятой передаче"""
+    text = f"✅ Игрок (ID: {transfer['receiver_id']}) принял вашу передачу!"
+    if transfer.get("money", 0) > 0:
+        text += f"\n💰 Передано: {transfer['money']}$"
+    if transfer.get("items"):
+        text += f"\n🎒 Предметы: {', '.join(transfer['items'].keys())}"
+    return text
+
+def failed_notice(transfer, reason):
+    """Уведомление отправителю о передаче, которая не выполнена"""
+    return f"❌ Передача игроку (ID: {transfer['receiver_id']}) не выполнена\n{reason}"
+
+async def shard_job_loop():
+    """Выполняет шаги передач между игроками разных шардов"""
+    while True:
+        await asyncio.sleep(SHARD_JOB_POLL_INTERVAL)
+        for job_id, kind, transfer in await run_io(shard_jobs.fetch, SHARD_INDEX):
+            try:
+                outcome, reason = await run_io(apply_transfer_step, job_id, kind, transfer)
+            except Exception as e:
+                # Шаг останется в очереди и будет повторен
+                print(f"Ошибка шага передачи {transfer['transfer_id']}: {e}")
+                break
+            if outcome == "done":
+                dispatcher.send_message(transfer["receiver_id"], "✅ Передача принята!", PRIORITY_NOTICE)
+                dispatcher.send_message(transfer["sender_id"], accepted_notice(transfer), PRIORITY_NOTICE)
+            elif outcome == "failed":
+                dispatcher.send_message(transfer["receiver_id"], f"❌ Ошибка при выполнении передачи\n{reason}",
+                                        PRIORITY_NOTICE)
+                dispatcher.send_message(transfer["sender_id"], failed_notice(transfer, reason), PRIORITY_NOTICE)
+
+async def on_startup(application):
+    """Запускает воркеры очереди и отправки сообщений"""
+    global request_queue
+    recovered = await run_io(recover_transfers)
+    if recovered:
+        print(f"Восстановлено незавершенных передач: {recovered}")
+    await run_io(init_leaderboard)
+    dispatcher.start(application)
+    request_queue = asyncio.Queue()
+    for _ in range(AI_WORKERS):
+        application.create_task(ai_worker())
+    application.create_task(queue_position_loop())
+    application.create_task(flush_loop())
+    application.create_task(expire_loop())
+    if SHARD_COUNT > 1:
+        application.create_task(shard_job_loop())
+    if METRICS_PORT:
+        # У каждого шарда свой порт
+        await start_http_server(METRICS_HOST, METRICS_PORT + SHARD_INDEX)
+    if METRICS_LOG_INTERVAL:
+        application.create_task(log_summary_loop(METRICS_LOG_INTERVAL))
+
+async def on_shutdown(application):
+    """Сохраняет данные игроков и закрывает соединения с API ИИ"""
+    close_user_data()
+    await close_client()
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /start"""
     user = update.effective_user
-    user_data = load_user_data(user.id, user.username, user.first_name)
+    user_data = await get_or_create_user(user.id, user.username, user.first_name)
     
     welcome_text = f"""
 🎮 ИГРА О ЖИЗНИ
 
 Привет, {user.first_name}! 
-💰 Баланс: {user_data['balance']}$ 
+💰 Баланс: {user_data.balance}$ 
 
 📊 Команды:
 /start - начать
@@ -58,7 +266,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 Пример: "передать 100$ и яблоко игроку 123456 с сообщением привет"
     """
     
-    await update.message.reply_text(welcome_text)
+    reply(update, welcome_text)
 
 async def profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /profile"""
@@ -67,73 +275,74 @@ async def profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if context.args:
         try:
             target_id = int(context.args[0])
-            user_data = load_user_data(target_id)
-            if "user_id" not in user_data:
-                await update.message.reply_text("❌ Игрок не найден")
-                return
         except ValueError:
-            await update.message.reply_text("❌ Неверный ID игрока")
+            reply(update, "❌ Неверный ID игрока")
+            return
+        user_data = await get_user(target_id)
+        if user_data is None:
+            reply(update, "❌ Игрок не найден")
             return
     else:
-        user_data = load_user_data(user.id)
+        user_data = await get_user(user.id)
+        if user_data is None:
+            reply(update, NOT_STARTED_TEXT)
+            return
     
+    rank = await run_io(leaderboard.rank, user_data.user_id)
+    ranked = await run_io(len, leaderboard)
     profile_text = f"""
 👤 ПРОФИЛЬ ИГРОКА
 
-ID: {user_data['user_id']}
-Имя: {user_data.get('first_name', 'Неизвестно')}
-Юзернейм: @{user_data.get('username', 'нет')}
-💰 Баланс: {user_data['balance']}$
-🎒 Предметов: {get_inventory_count(user_data['inventory'])}/20
+ID: {user_data.user_id}
+Имя: {user_data.first_name or 'Неизвестно'}
+Юзернейм: @{user_data.username or 'нет'}
+💰 Баланс: {user_data.balance}$
+🎒 Предметов: {user_data.inventory.total}/{INVENTORY_SLOTS}
+🏆 Место в рейтинге: {rank} из {ranked}
 
-📅 Зарегистрирован: {datetime.fromisoformat(user_data['registered_date']).strftime('%d.%m.%Y')}
+📅 Зарегистрирован: {datetime.fromisoformat(user_data.registered_date).strftime('%d.%m.%Y')}
     """
     
-    if user_data["inventory"]:
+    if user_data.inventory:
         profile_text += "\n🎒 ИНВЕНТАРЬ:\n"
-        for item, quantity in user_data["inventory"].items():
+        for item, quantity in user_data.inventory.items():
             profile_text += f"• {item}: {quantity} шт.\n"
     
-    await update.message.reply_text(profile_text)
+    reply(update, profile_text)
+
+def balance_text(user_data):
+    return f"💰 Ваш баланс: {user_data.balance}$"
+
+def inventory_text(user_data):
+    if not user_data.inventory:
+        return "🎒 Ваш инвентарь пуст"
+    text = f"🎒 ВАШ ИНВЕНТАРЬ ({user_data.inventory.total}/{INVENTORY_SLOTS}):\n"
+    for item, quantity in user_data.inventory.items():
+        text += f"• {item}: {quantity} шт.\n"
+    return text
+
+# Справки, на которые бот отвечает сам, без ИИ: намерение -> текст ответа
+LOCAL_ANSWERS = {INTENT_BALANCE: balance_text, INTENT_INVENTORY: inventory_text}
+
+async def answer_locally(update, render):
+    """Отвечает игроку по его данным (справка не регистрирует игрока)"""
+    user_data = await get_user(update.effective_user.id)
+    reply(update, NOT_STARTED_TEXT if user_data is None else render(user_data))
 
 async def balance(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /balance"""
-    user = update.effective_user
-    user_data = load_user_data(user.id)
-    
-    await update.message.reply_text(f"💰 Ваш баланс: {user_data['balance']}$")
+    await answer_locally(update, balance_text)
 
 async def inventory(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /inventory"""
-    user = update.effective_user
-    user_data = load_user_data(user.id)
-    
-    if user_data["inventory"]:
-        inventory_text = f"🎒 ВАШ ИНВЕНТАРЬ ({get_inventory_count(user_data['inventory'])}/20):\n"
-        for item, quantity in user_data["inventory"].items():
-            inventory_text += f"• {item}: {quantity} шт.\n"
-    else:
-        inventory_text = "🎒 Ваш инвентарь пуст"
-    
-    await update.message.reply_text(inventory_text)
+    await answer_locally(update, inventory_text)
 
 async def top_players(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /top"""
-    all_users = []
-    for filename in os.listdir("users"):
-        if filename.endswith('.json'):
-            user_file = os.path.join("users", filename)
-            with open(user_file, 'r', encoding='utf-8') as f:
-                user_data = json.load(f)
-                all_users.append(user_data)
-    
-    all_users.sort(key=lambda x: x['balance'], reverse=True)
-    
     top_text = "🏆 ТОП-15 ИГРОКОВ 🏆\n\n"
     
-    for i, user in enumerate(all_users[:15], 1):
-        username = user.get('username', '')
-        first_name = user.get('first_name', '')
+    top = await run_io(leaderboard.top, 15)
+    for i, (user_id, user_balance, username, first_name) in enumerate(top, 1):
         display_name = f"@{username}" if username else first_name
         
         medal = ""
@@ -141,27 +350,32 @@ async def top_players(update: Update, context: ContextTypes.DEFAULT_TYPE):
         elif i == 2: medal = "🥈" 
         elif i == 3: medal = "🥉"
         
-        top_text += f"{medal}{i}. {display_name}: {user['balance']}$ (ID: {user['user_id']})\n"
+        top_text += f"{medal}{i}. {display_name}: {user_balance}$ (ID: {user_id})\n"
     
-    if not all_users:
+    if not top:
         top_text = "📊 Пока нет игроков в рейтинге!"
     
-    await update.message.reply_text(top_text)
+    reply(update, top_text)
 
 async def handle_transfer(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик передачи"""
     user = update.effective_user
     text = update.message.text
     
-    # Парсим команду через ИИ
-    money, items, receiver_id, message = parse_transfer_command(text)
+    # Парсим команду (локально, при неуверенности через ИИ)
+    sender_data = await get_or_create_user(user.id, user.username, user.first_name)
+    try:
+        money, items, receiver_id, message = await parse_transfer_command(text, sender_data.inventory)
+    except AIError:
+        reply(update, "❌ Сервис ИИ недоступен. Попробуйте позже.")
+        return
     
     if not receiver_id:
-        await update.message.reply_text("❌ Не удалось распознать команду передачи. Пример: 'передать 100$ и яблоко игроку 123456 с сообщением привет'")
+        reply(update, "❌ Не удалось распознать команду передачи. Пример: 'передать 100$ и яблоко игроку 123456 с сообщением привет'")
         return
     
     # Создаем передачу
-    success, result = create_transfer(user.id, receiver_id, money, items, message)
+    success, result = await run_io(create_transfer, user.id, receiver_id, money, items, message)
     
     if success:
         transfer_id = result
@@ -182,17 +396,17 @@ async def handle_transfer(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if message:
             transfer_info += f"💬 Сообщение: {message}\n"
         
-        try:
-            await context.bot.send_message(
-                chat_id=receiver_id,
-                text=transfer_info,
-                reply_markup=reply_markup
-            )
-            await update.message.reply_text("✅ Запрос на передачу отправлен!")
-        except:
-            await update.message.reply_text("❌ Не удалось отправить запрос. Возможно, игрок не начал диалог с ботом.")
+        async def send_request():
+            """Отправляет запрос получателю, не задерживая обработку других сообщений"""
+            try:
+                await dispatcher.send_message(receiver_id, transfer_info, PRIORITY_NOTICE, reply_markup=reply_markup)
+                reply(update, "✅ Запрос на передачу отправлен!")
+            except TelegramError:
+                reply(update, "❌ Не удалось отправить запрос. Возможно, игрок не начал диалог с ботом.")
+        
+        context.application.create_task(send_request())
     else:
-        await update.message.reply_text(result)
+        reply(update, result)
 
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик кнопок"""
@@ -204,69 +418,66 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     if data.startswith('accept_'):
         transfer_id = data.replace('accept_', '')
-        transfer = pending_transfers.get(transfer_id)
+        transfer = await run_io(pending_transfers.get, transfer_id)
         
         if transfer and transfer["receiver_id"] == user_id:
-            success = execute_transfer(transfer_id)
-            if success:
-                await query.edit_message_text("✅ Передача принята!")
+            success, reason = await run_io(execute_transfer, transfer_id)
+            if success is None:
+                # Отправитель на другом шарде: итог придет отдельным сообщением
+                edit_reply(query, "⏳ Передача выполняется...")
+            elif success:
+                edit_reply(query, "✅ Передача принята!")
                 
                 # Уведомляем отправителя
-                try:
-                    sender_msg = f"✅ Игрок (ID: {user_id}) принял вашу передачу!"
-                    if transfer.get("money", 0) > 0:
-                        sender_msg += f"\n💰 Передано: {transfer['money']}$"
-                    if transfer.get("items"):
-                        sender_msg += f"\n🎒 Предметы: {', '.join(transfer['items'].keys())}"
-                    await context.bot.send_message(chat_id=transfer["sender_id"], text=sender_msg)
-                except:
-                    pass
+                dispatcher.send_message(transfer["sender_id"], accepted_notice(transfer), PRIORITY_NOTICE)
             else:
-                await query.edit_message_text("❌ Ошибка при выполнении передачи")
+                edit_reply(query, f"❌ Ошибка при выполнении передачи\n{reason}")
+                if reason != TRANSFER_NOT_FOUND:
+                    # Передача снята: отправитель узнает, почему она не выполнена
+                    dispatcher.send_message(transfer["sender_id"], failed_notice(transfer, reason), PRIORITY_NOTICE)
         else:
-            await query.edit_message_text("❌ Передача не найдена")
+            edit_reply(query, TRANSFER_NOT_FOUND)
     
     elif data.startswith('reject_'):
         transfer_id = data.replace('reject_', '')
-        transfer = pending_transfers.get(transfer_id)
+        transfer = await run_io(pending_transfers.get, transfer_id)
         
-        if transfer and transfer["receiver_id"] == user_id:
-            del pending_transfers[transfer_id]
-            await query.edit_message_text("❌ Передача отклонена")
+        if transfer and transfer["receiver_id"] == user_id and await run_io(pending_transfers.pop, transfer_id):
+            edit_reply(query, "❌ Передача отклонена")
             
             # Уведомляем отправителя
-            try:
-                await context.bot.send_message(
-                    chat_id=transfer["sender_id"], 
-                    text=f"❌ Игрок (ID: {user_id}) отклонил вашу передачу"
-                )
-            except:
-                pass
+            dispatcher.send_message(transfer["sender_id"], f"❌ Игрок (ID: {user_id}) отклонил вашу передачу", PRIORITY_NOTICE)
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик сообщений"""
-    user = update.effective_user
     user_input = update.message.text.strip()
     
-    # Проверяем是否是 команда передачи
-    if any(word in user_input.lower() for word in ['передать', 'кинуть', 'отдать', 'дать']):
+    # Передачи и справки о балансе/инвентаре обрабатываются без очереди ИИ
+    intent = classify(user_input)
+    if intent == INTENT_TRANSFER:
         await handle_transfer(update, context)
         return
+    if intent in LOCAL_ANSWERS:
+        await answer_locally(update, LOCAL_ANSWERS[intent])
+        return
     
-    user_data = load_user_data(user.id, user.username, user.first_name)
-    
-    request_queue.append((update, context, user_input, user_data))
-    await update.message.reply_text("⏳ Ваш запрос добавлен в очередь...")
+    result = enqueue_action(update, context, user_input)
+    if result in REJECT_TEXTS:
+        reply(update, REJECT_TEXTS[result])
 
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик ошибок"""
     print(f"Ошибка: {context.error}")
     if update and update.message:
-        await update.message.reply_text("⚠️ Произошла ошибка. Попробуйте позже.")
+        reply(update, "⚠️ Произошла ошибка. Попробуйте позже.")
 
-def main():
-    """Запуск бота"""
-    application = Application.builder().token(TELEGRAM_TOKEN).build()
+def build_application():
+    """Создает приложение бота с обработчиками"""
+    builder = Application.builder().token(TELEGRAM_TOKEN).post_init(on_startup).post_shutdown(on_shutdown)
+    if SHARD_COUNT > 1:
+        # Обновления шарду присылает процесс приема, свой Updater не нужен
+        builder.updater(None)
+    application = builder.build()
     
     # Регистрируем обработчики
     application.add_handler(CommandHandler("start", start))
@@ -278,13 +489,25 @@ def main():
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
     
     application.add_error_handler(error_handler)
-    
-    # Запускаем обработку очереди
-    loop = asyncio.get_event_loop()
-    loop.create_task(process_queue())
+    return application
+
+def run_shard(queue):
+    """Процесс-шард: обрабатывает игроков своей части кольца"""
+    run_shard_process(build_application, queue)
+
+def main():
+    """Запуск бота"""
+    if SHARD_WORKERS > 1:
+        # Этот процесс только принимает обновления и раздает их шардам
+        application = start_shards(run_shard, SHARD_WORKERS)
+    else:
+        application = build_application()
     
     print("Бот запущен...")
-    application.run_polling()
+    if WEBHOOK_URL:
+        run_webhook(application)
+    else:
+        application.run_polling()
 
 if __name__ == "__main__":
     main()
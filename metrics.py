@@ -0,0 +1,174 @@
+import time
+import bisect
+import asyncio
+from contextlib import contextmanager
+
+# Границы корзин гистограмм задержек, секунды
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in pairs) + "}"
+
+class Counter:
+    """Счетчик с метками"""
+    kind = "counter"
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self.values = {}
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        for key, value in self.values.items():
+            yield self.name, key, value
+
+class Gauge(Counter):
+    """Текущее значение; может вычисляться функцией при чтении"""
+    kind = "gauge"
+
+    def __init__(self, name, help_text, func=None):
+        super().__init__(name, help_text)
+        self.func = func
+
+    def set(self, value, **labels):
+        self.values[_label_key(labels)] = value
+
+    def samples(self):
+        if self.func is not None:
+            for labels, value in self.func():
+                yield self.name, _label_key(labels), value
+        else:
+            yield from super().samples()
+
+class Histogram:
+    """Гистограмма с фиксированными корзинами: observe - один bisect"""
+    kind = "histogram"
+
+    def __init__(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.buckets = buckets
+        self.series = {}  # метки -> [счетчики корзин, сумма, количество]
+
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+        series = self.series.get(key)
+        if series is None:
+            series = self.series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def quantile(self, q, **labels):
+        """Оценка квантиля по корзинам (верхняя граница корзины)"""
+        series = self.series.get(_label_key(labels))
+        if not series or not series[2]:
+            return None
+        rank = q * series[2]
+        total = 0
+        for bound, count in zip(self.buckets + (float("inf"),), series[0]):
+            total += count
+            if total >= rank:
+                return bound
+        return float("inf")
+
+    def samples(self):
+        for key, (counts, total, count) in self.series.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                yield f"{self.name}_bucket", key + (("le", le),), cumulative
+            yield f"{self.name}_sum", key, total
+            yield f"{self.name}_count", key, count
+
+_registry = []
+
+def register(metric):
+    _registry.append(metric)
+    return metric
+
+def render():
+    """Все метрики в текстовом формате Prometheus"""
+    lines = []
+    for metric in _registry:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for name, key, value in metric.samples():
+            lines.append(f"{name}{_format_labels(key)} {value}")
+    return "\n".join(lines) + "\n"
+
+# Общие метрики бота
+STAGE_SECONDS = register(Histogram(
+    "lifesim_stage_seconds", "Длительность этапов обработки: parse, validate, llm, persist, send"))
+QUEUE_WAIT_SECONDS = register(Histogram(
+    "lifesim_queue_wait_seconds", "Время ожидания действия в очереди до начала обработки"))
+LLM_REQUESTS = register(Counter(
+    "lifesim_llm_requests_total", "Попытки запросов к ИИ по статусу ответа"))
+
+def stage(name):
+    """Замер длительности этапа: with stage("llm"): ..."""
+    return STAGE_SECONDS.time(stage=name)
+
+def stats_gauge(name, help_text, stats, label="name"):
+    """Публикует словарь счетчиков модуля как метрику с меткой по ключу"""
+    return register(Gauge(name, help_text, lambda: [({label: key}, value) for key, value in stats.items()]))
+
+def summary():
+    """Короткая сводка для периодического лога"""
+    parts = []
+    for metric in _registry:
+        if isinstance(metric, Histogram):
+            for key, (_, total, count) in metric.series.items():
+                if count:
+                    labels = dict(key)
+                    parts.append(f"{metric.name}{_format_labels(key)}: n={count} "
+                                 f"avg={total / count:.3f}s p95<={metric.quantile(0.95, **labels)}s")
+        else:
+            for name, key, value in metric.samples():
+                parts.append(f"{name}{_format_labels(key)}={value}")
+    return "\n".join(parts)
+
+async def log_summary_loop(interval):
+    """Периодически печатает сводку метрик"""
+    while True:
+        await asyncio.sleep(interval)
+        print(f"Метрики:\n{summary()}")
+
+async def _handle_http(reader, writer):
+    try:
+        request_line = await reader.readline()
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass
+        parts = request_line.decode("latin-1").split()
+        if len(parts) >= 2 and parts[1].split("?")[0] == "/metrics":
+            body, status = render().encode(), "200 OK"
+        else:
+            body, status = b"not found\n", "404 Not Found"
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                     f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+        await writer.drain()
+    finally:
+        writer.close()
+
+async def start_http_server(host, port):
+    """Запускает HTTP сервер с /metrics для Prometheus"""
+    return await asyncio.start_server(_handle_http, host, port)
@@ -0,0 +1,57 @@
+import sys
+import json
+import sqlite3
+from config import (USERS_DIR, SQLITE_PATH, HISTORY_DIR, HISTORY_SEGMENT_BYTES, HISTORY_MAX_SEGMENTS,
+                    HISTORY_MAX_EVENTS)
+from storage import JsonStorage, SqliteStorage
+from eventlog import EventLog
+
+def create_event_log():
+    return EventLog(HISTORY_DIR, HISTORY_SEGMENT_BYTES, HISTORY_MAX_SEGMENTS, HISTORY_MAX_EVENTS)
+
+def migrate(users_dir=USERS_DIR, db_path=SQLITE_PATH):
+    """Переносит игроков из users/*.json в SQLite, историю - в журнал событий.
+    Перенесенная история удаляется из JSON файла, поэтому повторный запуск
+    или возврат к хранилищу JSON не дублирует события"""
+    source = JsonStorage(users_dir)
+    target = SqliteStorage(db_path)
+    event_log = create_event_log()
+    count = 0
+    try:
+        for user_data in source.iter_users():
+            if "history" in user_data.extra:
+                event_log.extend(user_data.user_id, user_data.extra.pop("history"))
+                source.save(user_data)
+            target.save(user_data)
+            count += 1
+    finally:
+        target.close()
+    return count
+
+def migrate_sqlite_history(db_path=SQLITE_PATH):
+    """Переносит историю из таблицы history старых баз SQLite в журнал событий"""
+    conn = sqlite3.connect(db_path)
+    event_log = create_event_log()
+    count = 0
+    try:
+        if conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'history'").fetchone() is None:
+            return 0
+        user_ids = [row[0] for row in conn.execute("SELECT DISTINCT user_id FROM history")]
+        for user_id in user_ids:
+            events = [json.loads(event) for (event,) in conn.execute(
+                "SELECT event FROM history WHERE user_id = ? ORDER BY id", (user_id,))]
+            event_log.extend(user_id, events)
+            count += len(events)
+        with conn:
+            conn.execute("DROP TABLE history")
+    finally:
+        conn.close()
+    return count
+
+if __name__ == "__main__":
+    count = migrate(*sys.argv[1:3])
+    print(f"Перенесено игроков: {count}")
+    events = migrate_sqlite_history(*sys.argv[2:3])
+    if events:
+        print(f"Перенесено событий истории из SQLite: {events}")
+    print('Чтобы использовать SQLite, укажите STORAGE_BACKEND = "sqlite" в config.py')
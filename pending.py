@@ -0,0 +1,142 @@
+import json
+import time
+import heapq
+import sqlite3
+import threading
+from collections import defaultdict
+
+class PendingTransferStore:
+    """Ожидающие подтверждения передачи: хранятся в SQLite, истекают через ttl секунд.
+
+    В памяти держится словарь по ID и куча по времени истечения; записи удаляются
+    при принятии, отклонении или истечении, поэтому память ограничена числом
+    игроков, умноженным на max_per_sender. Захват передачи (pop) идет через
+    DELETE в базе, поэтому одну передачу нельзя принять дважды даже из разных процессов.
+    Передачу, созданную в этом процессе, может принять или отклонить другой (шард
+    получателя): лимит отправителя считается по базе, а такие записи убирает из памяти expire.
+    """
+
+    def __init__(self, path, ttl, max_per_sender):
+        self.ttl = ttl
+        self.max_per_sender = max_per_sender
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript("""
+        CREATE TABLE IF NOT EXISTS pending_transfers (
+            transfer_id TEXT PRIMARY KEY,
+            sender_id INTEGER NOT NULL,
+            expires_at REAL NOT NULL,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS pending_expires ON pending_transfers(expires_at);
+        CREATE INDEX IF NOT EXISTS pending_sender ON pending_transfers(sender_id, expires_at);
+        """)
+        self._items = {}
+        self._heap = []
+        self._by_sender = defaultdict(set)
+        for transfer_id, expires_at, data in self.conn.execute(
+                "SELECT transfer_id, expires_at, data FROM pending_transfers"):
+            self._remember(transfer_id, json.loads(data), expires_at)
+
+    def _remember(self, transfer_id, transfer, expires_at):
+        transfer["expires_at"] = expires_at
+        self._items[transfer_id] = transfer
+        self._by_sender[transfer["sender_id"]].add(transfer_id)
+        heapq.heappush(self._heap, (expires_at, transfer_id))
+
+    def _forget(self, transfer_id):
+        transfer = self._items.pop(transfer_id, None)
+        if transfer is not None:
+            sender_ids = self._by_sender[transfer["sender_id"]]
+            sender_ids.discard(transfer_id)
+            if not sender_ids:
+                del self._by_sender[transfer["sender_id"]]
+        # Удаленные записи остаются в куче до истечения; если их стало много - перестраиваем
+        if len(self._heap) > 2 * len(self._items) + 1000:
+            self._heap = [(t["expires_at"], i) for i, t in self._items.items()]
+            heapq.heapify(self._heap)
+        return transfer
+
+    def add(self, transfer_id, transfer):
+        """Сохраняет передачу. Возвращает False, если у отправителя слишком много ожидающих"""
+        with self._lock:
+            now = time.time()
+            (pending,) = self.conn.execute(
+                "SELECT COUNT(*) FROM pending_transfers WHERE sender_id = ? AND expires_at > ?",
+                (transfer["sender_id"], now)
+            ).fetchone()
+            if pending >= self.max_per_sender:
+                return False
+            expires_at = now + self.ttl
+            with self.conn:
+                self.conn.execute(
+                    "INSERT INTO pending_transfers (transfer_id, sender_id, expires_at, data) VALUES (?, ?, ?, ?)",
+                    (transfer_id, transfer["sender_id"], expires_at, json.dumps(transfer, ensure_ascii=False))
+                )
+            self._remember(transfer_id, transfer, expires_at)
+            return True
+
+    def get(self, transfer_id, default=None):
+        """Возвращает передачу по ID"""
+        transfer = self._items.get(transfer_id)
+        if transfer is None:
+            # Передачу мог создать другой процесс
+            with self._lock:
+                row = self.conn.execute(
+                    "SELECT expires_at, data FROM pending_transfers WHERE transfer_id = ?", (transfer_id,)
+                ).fetchone()
+            if row is None:
+                return default
+            transfer = dict(json.loads(row[1]), expires_at=row[0])
+        if transfer["expires_at"] <= time.time():
+            return default
+        return transfer
+
+    def pop(self, transfer_id, default=None):
+        """Забирает передачу: после этого ее нельзя принять или отклонить повторно"""
+        with self._lock:
+            with self.conn:
+                row = self.conn.execute(
+                    "SELECT data FROM pending_transfers WHERE transfer_id = ?", (transfer_id,)
+                ).fetchone() if transfer_id not in self._items else None
+                deleted = self.conn.execute(
+                    "DELETE FROM pending_transfers WHERE transfer_id = ? AND expires_at > ?",
+                    (transfer_id, time.time())
+                ).rowcount
+            if not deleted:
+                # Истекшая передача остается expire: он удалит ее и сообщит отправителю
+                return default
+            transfer = self._forget(transfer_id)
+            if transfer is None and row is not None:
+                transfer = json.loads(row[0])
+        return transfer
+
+    def expire(self):
+        """Удаляет истекшие передачи и возвращает их список"""
+        now = time.time()
+        expired = []
+        with self._lock:
+            # Передачи, которые принял или отклонил другой процесс, уже удалены из базы
+            stored = {transfer_id for (transfer_id,) in self.conn.execute("SELECT transfer_id FROM pending_transfers")}
+            for transfer_id in [transfer_id for transfer_id in self._items if transfer_id not in stored]:
+                self._forget(transfer_id)
+            with self.conn:
+                while self._heap and self._heap[0][0] <= now:
+                    _, transfer_id = heapq.heappop(self._heap)
+                    transfer = self._forget(transfer_id)
+                    # Передачу мог уже забрать или удалить другой процесс
+                    if transfer is not None and self.conn.execute(
+                            "DELETE FROM pending_transfers WHERE transfer_id = ?", (transfer_id,)).rowcount:
+                        expired.append(transfer)
+        return expired
+
+    def __contains__(self, transfer_id):
+        return self.get(transfer_id) is not None
+
+    def __len__(self):
+        return len(self._items)
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
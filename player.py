@@ -0,0 +1,190 @@
+import json
+from config import INVENTORY_SLOTS, MAX_INVENTORY_ITEMS
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Версия формата записи игрока. Записи старых версий обновляются при чтении
+SCHEMA_VERSION = 2
+
+# Поля, которые меняют передачи; остальные данные игрока журнал передач не трогает
+LEDGER_FIELDS = ("balance", "inventory", "transfer_steps")
+
+class InventoryError(ValueError):
+    """Изменение инвентаря нарушает правила; reasons - список (code, предмет)"""
+
+    def __init__(self, reasons):
+        super().__init__(", ".join(code for code, _ in reasons))
+        self.reasons = reasons
+
+class Inventory:
+    """Инвентарь игрока: количество каждого предмета и общее число предметов.
+
+    Общее число поддерживается при каждом изменении, поэтому не пересчитывается.
+    Изменения применяются пакетом: сначала проверяется итоговое состояние
+    (одна проверка вместимости на весь пакет), затем все изменения вносятся разом."""
+
+    __slots__ = ("_items", "total")
+
+    def __init__(self, items=None):
+        self._items = {item: quantity for item, quantity in (items or {}).items() if quantity > 0}
+        self.total = sum(self._items.values())
+
+    def get(self, item, default=0):
+        return self._items.get(item, default)
+
+    def items(self):
+        return self._items.items()
+
+    def __contains__(self, item):
+        return item in self._items
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def __len__(self):
+        return len(self._items)
+
+    def to_dict(self):
+        return dict(self._items)
+
+    def _plan(self, deltas, clamp, slots, max_items):
+        """Итоговые количества, общее число и нарушения для пакета изменений"""
+        reasons = []
+        quantities = {}
+        total = self.total
+        for item, delta in deltas.items():
+            owned = self._items.get(item, 0)
+            quantity = owned + delta
+            if quantity < 0:
+                if not clamp:
+                    reasons.append(("missing_item" if owned == 0 else "insufficient_items", item))
+                quantity = 0
+            if max_items is not None and delta > 0 and quantity > max_items:
+                reasons.append(("item_limit", item))
+            quantities[item] = quantity
+            total += quantity - owned
+        # Пакет, который не увеличивает инвентарь, разрешен даже сверх лимита
+        if slots is not None and total > slots and total > self.total:
+            reasons.append(("inventory_full", None))
+        return quantities, total, reasons
+
+    def check(self, deltas, clamp=False, slots=INVENTORY_SLOTS, max_items=MAX_INVENTORY_ITEMS):
+        """Проверяет пакет изменений {предмет: +/-количество}. Возвращает список нарушений.
+        clamp - списание больше имеющегося просто убирает предмет"""
+        return self._plan(deltas, clamp, slots, max_items)[2]
+
+    def apply(self, deltas, clamp=False, slots=INVENTORY_SLOTS, max_items=MAX_INVENTORY_ITEMS):
+        """Применяет пакет изменений целиком или не применяет ничего (InventoryError).
+        Возвращает фактические изменения {предмет: (было, стало)}"""
+        quantities, total, reasons = self._plan(deltas, clamp, slots, max_items)
+        if reasons:
+            raise InventoryError(reasons)
+        changes = {}
+        for item, quantity in quantities.items():
+            owned = self._items.get(item, 0)
+            if quantity == owned:
+                continue
+            changes[item] = (owned, quantity)
+            if quantity:
+                self._items[item] = quantity
+            else:
+                del self._items[item]
+        self.total = total
+        return changes
+
+    def __repr__(self):
+        return f"Inventory({self._items})"
+
+class Player:
+    """Данные игрока.
+
+    Поля хранятся в __slots__: у записи нет собственного словаря атрибутов,
+    поэтому большой кэш игроков занимает заметно меньше памяти. Неизвестные
+    поля (из более новых версий или ручных правок) сохраняются в extra."""
+
+    __slots__ = ("user_id", "username", "first_name", "balance", "inventory", "message_history",
+                 "registered_date", "summary", "summary_pending", "transfer_steps", "extra")
+
+    def __init__(self, user_id, username="", first_name="", balance=0, inventory=None, message_history=None,
+                 registered_date=None, summary="", summary_pending=None, transfer_steps=None, extra=None):
+        self.user_id = int(user_id)
+        self.username = username or ""
+        self.first_name = first_name or ""
+        self.balance = balance
+        self.inventory = inventory if isinstance(inventory, Inventory) else Inventory(inventory)
+        self.message_history = message_history if message_history is not None else []
+        self.registered_date = registered_date
+        self.summary = summary or ""
+        self.summary_pending = summary_pending if summary_pending is not None else []
+        self.transfer_steps = transfer_steps if transfer_steps is not None else []
+        self.extra = extra if extra is not None else {}
+
+    def to_dict(self):
+        """Словарь для сохранения; пустые необязательные поля опускаются"""
+        data = {
+            "v": SCHEMA_VERSION,
+            "user_id": self.user_id,
+            "username": self.username,
+            "first_name": self.first_name,
+            "balance": self.balance,
+            "inventory": self.inventory.to_dict(),
+            "message_history": self.message_history,
+            "registered_date": self.registered_date,
+        }
+        if self.summary:
+            data["summary"] = self.summary
+        if self.summary_pending:
+            data["summary_pending"] = self.summary_pending
+        if self.transfer_steps:
+            data["transfer_steps"] = self.transfer_steps
+        data.update(self.extra)
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        """Создает игрока из сохраненного словаря любой версии"""
+        data = migrate_record(dict(data))
+        data.pop("v", None)
+        fields = {name: data.pop(name) for name in cls.__slots__ if name in data and name != "extra"}
+        return cls(**fields, extra=data)
+
+    def replace_with(self, other, fields=__slots__):
+        """Заменяет данные игрока данными другой записи (живой объект в кэше остается тем же).
+        fields - какие поля заменить"""
+        for name in fields:
+            setattr(self, name, getattr(other, name))
+
+    def __repr__(self):
+        return f"Player({self.user_id}, balance={self.balance})"
+
+def _migrate_v1(data):
+    # Версия 1 - словари без номера версии: поля могли отсутствовать, ID - строкой
+    data.setdefault("message_history", [])
+    data.setdefault("inventory", {})
+    data["user_id"] = int(data["user_id"])
+    return data
+
+# Миграции: версия -> функция, переводящая запись в следующую версию
+MIGRATIONS = {1: _migrate_v1}
+
+def migrate_record(data):
+    """Обновляет сохраненную запись до текущей версии"""
+    version = data.get("v", 1)
+    while version < SCHEMA_VERSION:
+        data = MIGRATIONS[version](data)
+        version += 1
+    data["v"] = version
+    return data
+
+def encode(player):
+    """Кодирует игрока в компактный JSON (без отступов и пробелов)"""
+    if orjson is not None:
+        return orjson.dumps(player.to_dict())
+    return json.dumps(player.to_dict(), ensure_ascii=False, separators=(",", ":")).encode()
+
+def decode(raw):
+    """Декодирует игрока из JSON, в том числе из файлов старого формата"""
+    return Player.from_dict(orjson.loads(raw) if orjson is not None else json.loads(raw))
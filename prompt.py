@@ -1,21 +1,46 @@
-import re
 import os
-import json
+import re
+import asyncio
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from api import call_ai
-from config import USERS_DIR
+from api import call_ai, stream_ai, AIError
+from cache import UserCache
+from context import message_tokens, select_history, age_out, schedule_summary
+from streaming import collect_stream
+from storage import create_storage
+from leaderboard import Leaderboard, ShardedLeaderboard
+from eventlog import EventLog
+from ledger import TransferLedger
+from player import Player, InventoryError, LEDGER_FIELDS
+from sharding import shard_path, is_local_user, SHARD_INDEX, SHARD_COUNT
+from metrics import stage, stats_gauge, register, Gauge
+from config import (PROMPT_FILE, USER_CACHE_SIZE, CACHE_FLUSH_THRESHOLD, LEADERBOARD_FILE, INVENTORY_SLOTS,
+                    CONTEXT_TOKEN_BUDGET, STREAM_EDIT_INTERVAL, HISTORY_DIR, HISTORY_SEGMENT_BYTES,
+                    HISTORY_MAX_SEGMENTS, HISTORY_MAX_EVENTS, MAX_INVENTORY_ITEMS, IO_WORKERS, TRANSFER_JOURNAL,
+                    SHARD_LEADERBOARD_DB)
+
+DEFAULT_PROMPT = "Ты ведущий игры о жизни. Игрок начинает с 1000$ и пустым инвентарем."
+
+# Промпт хранится в памяти и перечитывается только при изменении файла
+_prompt_cache = {"mtime": None, "text": DEFAULT_PROMPT}
 
 def load_prompt():
     """Загружает промпт из файла"""
     try:
-        with open("prompt.txt", 'r', encoding='utf-8') as f:
-            return f.read()
-    except:
-        return "Ты ведущий игры о жизни. Игрок начинает с 1000$ и пустым инвентарем."
+        mtime = os.stat(PROMPT_FILE).st_mtime_ns
+        if mtime != _prompt_cache["mtime"]:
+            with open(PROMPT_FILE, 'r', encoding='utf-8') as f:
+                _prompt_cache["text"] = f.read()
+            _prompt_cache["mtime"] = mtime
+    except OSError:
+        _prompt_cache["mtime"] = None
+        _prompt_cache["text"] = DEFAULT_PROMPT
+    return _prompt_cache["text"]
 
 def parse_ai_response(response):
     """Парсит ответ AI"""
-    if not response or "Ошибка" in response:
+    if not response:
         return {
             'response': response or "Произошла ошибка",
             'balance': None,
@@ -43,138 +68,258 @@ def parse_ai_response(response):
         'raw': response
     }
 
-def get_user_file(user_id):
-    """Возвращает путь к файлу пользователя"""
-    return os.path.join(USERS_DIR, f"{user_id}.json")
+storage = create_storage()
+event_log = EventLog(HISTORY_DIR, HISTORY_SEGMENT_BYTES, HISTORY_MAX_SEGMENTS, HISTORY_MAX_EVENTS)
+
+def fetch_user_data(user_id):
+    """Читает данные пользователя из хранилища.
+    История старого формата (список в данных игрока) переносится в журнал событий"""
+    user_data = storage.load(user_id)
+    if user_data is not None and "history" in user_data.extra:
+        event_log.extend(user_data.user_id, user_data.extra.pop("history"))
+        storage.save(user_data)
+    return user_data
+
+def persist_user_data(user_data):
+    """Записывает данные пользователя в хранилище"""
+    with stage("persist"):
+        storage.save(user_data)
+
+# Запись при put отключена: сбрасывает кэш flush_loop в потоке работы с диском
+user_cache = UserCache(fetch_user_data, persist_user_data, USER_CACHE_SIZE, flush_threshold=None)
+# В шардах рейтинг общий: свои игроки в памяти, игроки других шардов - из общей таблицы
+leaderboard = Leaderboard() if SHARD_COUNT == 1 else ShardedLeaderboard(SHARD_LEADERBOARD_DB, SHARD_INDEX)
+stats_gauge("lifesim_user_cache", "Кэш игроков: попадания, промахи, записи на диск", user_cache.stats, "kind")
+register(Gauge("lifesim_user_cache_size", "Игроков в кэше", lambda: [({}, len(user_cache))]))
+
+# Потоки для работы с диском: цикл событий не ждет чтения и записи файлов
+io_executor = ThreadPoolExecutor(IO_WORKERS, thread_name_prefix="storage")
+
+async def run_io(func, *args):
+    """Выполняет блокирующую операцию с хранилищем в потоке работы с диском"""
+    return await asyncio.get_running_loop().run_in_executor(io_executor, func, *args)
+
+def find_user_data(user_id):
+    """Данные существующего пользователя или None. Новую запись не создает.
+    Игрока другого шарда читает прямо из хранилища и не кэширует: его данные
+    меняет другой процесс, и копия в кэше устарела бы"""
+    if not is_local_user(user_id):
+        return storage.load(user_id)
+    return user_cache.get(user_id)
 
 def load_user_data(user_id, username="", first_name=""):
-    """Загружает данные пользователя"""
-    user_file = get_user_file(user_id)
-    
-    try:
-        if os.path.exists(user_file):
-            with open(user_file, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                # Проверяем обязательные поля
-                if "message_history" not in data:
-                    data["message_history"] = []
-                if "inventory" not in data:
-                    data["inventory"] = {}
-                return data
-    except json.JSONDecodeError:
-        print(f"Ошибка чтения файла пользователя {user_id}, создаем новый")
+    """Загружает данные пользователя, при отсутствии регистрирует его"""
+    data = user_cache.get(user_id)
+    if data is not None:
+        return data
     
     # Создаем нового пользователя
-    user_data = {
-        "user_id": user_id,
-        "username": username or "",
-        "first_name": first_name or "",
-        "balance": 1000,
-        "inventory": {},
-        "message_history": [],
-        "registered_date": datetime.now().isoformat(),
-        "history": []
-    }
+    user_data = Player(user_id, username, first_name, balance=1000, registered_date=datetime.now().isoformat())
     save_user_data(user_data)
     return user_data
 
+async def get_user(user_id):
+    """Данные существующего пользователя или None (без блокировки цикла событий)"""
+    user_data = user_cache.cached(user_id)
+    if user_data is not None:
+        return user_data
+    return await run_io(find_user_data, user_id)
+
+async def get_or_create_user(user_id, username="", first_name=""):
+    """Данные пользователя; новый пользователь регистрируется"""
+    user_data = user_cache.cached(user_id)
+    if user_data is not None:
+        return user_data
+    return await run_io(load_user_data, user_id, username, first_name)
+
+@asynccontextmanager
+async def active_user(user_id, username="", first_name=""):
+    """Данные игрока на время действия (новый игрок регистрируется).
+    Запись закреплена в кэше: пока действие ждет ИИ, передачи меняют тот же объект,
+    и сохранение действия не затирает их более новой записью"""
+    with user_cache.pinned(user_id):
+        yield await get_or_create_user(user_id, username, first_name)
+
+def flush_due():
+    """Накопилось ли достаточно изменений для досрочного сброса на диск"""
+    return user_cache.dirty_count() >= CACHE_FLUSH_THRESHOLD
+
 def save_user_data(user_data):
-    """Сохраняет данные пользователя"""
-    try:
-        user_file = get_user_file(user_data["user_id"])
-        with open(user_file, 'w', encoding='utf-8') as f:
-            json.dump(user_data, f, ensure_ascii=False, indent=2)
-    except Exception as e:
-        print(f"Ошибка сохранения пользователя {user_data['user_id']}: {e}")
+    """Сохраняет данные пользователя (запись на диск отложенная)"""
+    user_cache.put(user_data)
+    leaderboard.update(user_data.user_id, user_data.balance,
+                       user_data.username, user_data.first_name)
+
+def record_event(user_id, event):
+    """Дописывает событие в историю игрока"""
+    event_log.append(user_id, event)
+
+def get_user_history(user_id, offset=0, limit=20):
+    """Страница истории игрока, от новых событий к старым"""
+    return event_log.read(user_id, offset, limit)
+
+def flush_user_data(user_ids=None):
+    """Сбрасывает измененные данные пользователей на диск"""
+    return user_cache.flush(user_ids)
+
+def write_transfer_records(records):
+    """Сохраняет итог передачи на диск и только после этого переносит его в живые
+    данные участников. Меняются только поля передачи: реплики, память и прочие данные
+    игрока, измененные за это время, остаются как есть"""
+    players = [Player.from_dict(record) for record in records]
+    user_cache.write_through(players, lambda user_data, player: user_data.replace_with(player, LEDGER_FIELDS))
+    for player in players:
+        leaderboard.update(player.user_id, player.balance, player.username, player.first_name)
+
+def restore_transfer_users(user_ids):
+    """Возвращает на диск живые данные участников передачи, которую не удалось записать"""
+    if not user_cache.rewrite(user_ids):
+        raise IOError("Не удалось восстановить участников передачи")
+
+# Журнал передач. Его блокировки по игрокам защищают баланс и инвентарь:
+# под ними выполняются передачи и применяются ответы ИИ
+ledger = TransferLedger(shard_path(TRANSFER_JOURNAL), write_transfer_records, restore_transfer_users)
+
+def init_leaderboard():
+    """Загружает снимок рейтинга или строит рейтинг по хранилищу"""
+    if not leaderboard.load(shard_path(LEADERBOARD_FILE)):
+        leaderboard.build(user for user in iter_all_users() if is_local_user(user.user_id))
+
+def publish_leaderboard():
+    """Публикует изменения рейтинга для других шардов"""
+    if SHARD_COUNT > 1:
+        leaderboard.publish()
+
+def close_user_data():
+    """Сохраняет данные пользователей и закрывает хранилище"""
+    flush_user_data()
+    ledger.resolve()
+    storage.close()
+    leaderboard.save(shard_path(LEADERBOARD_FILE))
+    io_executor.shutdown()
+
+def iter_all_users():
+    """Перебирает всех игроков в хранилище"""
+    flush_user_data()
+    return storage.iter_users()
 
 def update_message_history(user_data, message, role="user"):
     """Обновляет историю сообщений"""
-    user_data["message_history"].append({
+    user_data.message_history.append({
         "role": role,
         "content": message,
         "timestamp": datetime.now().isoformat()
     })
-    user_data["message_history"] = user_data["message_history"][-5:]
+    age_out(user_data, user_data.message_history[:-5])
+    user_data.message_history = user_data.message_history[-5:]
     save_user_data(user_data)
 
-def get_inventory_count(inventory):
-    """Возвращает количество предметов"""
-    return sum(inventory.values())
+def render_player_state(user_data):
+    """Текущее состояние игрока для ИИ"""
+    state = f"ТЕКУЩАЯ ИНФОРМАЦИЯ:\nБаланс: {user_data.balance}$\n"
+    
+    if user_data.inventory:
+        state += "Инвентарь:\n"
+        for item, quantity in user_data.inventory.items():
+            state += f"- {item}: {quantity} шт.\n"
+    else:
+        state += "Инвентарь: пусто\n"
+    
+    state += f"Количество предметов: {user_data.inventory.total}/{INVENTORY_SLOTS}\n"
+    
+    # Краткое содержание реплик, которые уже не помещаются в контекст
+    if user_data.summary:
+        state += f"\nРАНЕЕ В ИГРЕ:\n{user_data.summary}\n"
+    
+    return state
 
-def process_user_action(user_input, user_data):
-    """Обрабатывает действие пользователя через ИИ"""
-    try:
-        system_prompt = load_prompt()
-        system_prompt += f"\n\nТЕКУЩАЯ ИНФОРМАЦИЯ:\nБаланс: {user_data['balance']}$\n"
-        
-        if user_data["inventory"]:
-            system_prompt += "Инвентарь:\n"
-            for item, quantity in user_data["inventory"].items():
-                system_prompt += f"- {item}: {quantity} шт.\n"
-        else:
-            system_prompt += "Инвентарь: пусто\n"
-        
-        system_prompt += f"Количество предметов: {get_inventory_count(user_data['inventory'])}/20\n"
-        
-        # Добавляем историю сообщений
-        if user_data["message_history"]:
-            system_prompt += "\nПОСЛЕДНИЕ ДЕЙСТВИЯ ИГРОКА:\n"
-            for msg in user_data["message_history"][-3:]:
-                system_prompt += f"- {msg['content']}\n"
-        
-        messages = [{"role": "system", "content": system_prompt}]
+def build_messages(user_input, user_data):
+    """Собирает сообщения для ИИ.
+    Системный промпт идет первым и не меняется между запросами, поэтому провайдер
+    может кэшировать его как общий префикс; данные игрока идут в конце"""
+    messages = [{"role": "system", "content": load_prompt()}]
+    request = {"role": "user", "content": f"{render_player_state(user_data)}\nДЕЙСТВИЕ ИГРОКА: {user_input}"}
+    
+    # Добавляем в контекст столько последних реплик, сколько помещается в бюджет
+    budget = CONTEXT_TOKEN_BUDGET - message_tokens(messages[0]) - message_tokens(request)
+    for msg in select_history(user_data.message_history, budget):
+        messages.append({"role": msg["role"], "content": msg["content"]})
+    
+    messages.append(request)
+    return messages
+
+def apply_action_result(user_data, parsed, shown_balance):
+    """Применяет баланс и инвентарь из ответа ИИ под блокировкой игрока в журнале передач.
+    ИИ видел баланс shown_balance: новый баланс из ответа переводится в изменение
+    относительно него, поэтому передача, выполненная, пока ИИ отвечал, не затирается.
+    Возвращает (баланс до и после, изменения инвентаря, коды нарушений)"""
+    with ledger.lock_users(user_data.user_id):
+        old_balance = balance = user_data.balance
+        if parsed['balance'] is not None:
+            balance += parsed['balance'] - shown_balance
+            if balance < 0:
+                # Деньги, на которые рассчитан ответ, ушли передачей
+                return old_balance, old_balance, {}, {"insufficient_funds"}
         
-        # Добавляем историю в контекст
-        for msg in user_data["message_history"]:
-            messages.append({"role": msg["role"], "content": msg["content"]})
+        # Инвентарь: все изменения ответа применяются вместе или не применяются
+        changes = {}
+        codes = set()
+        try:
+            changes = user_data.inventory.apply(parsed['inventory'], clamp=True)
+        except InventoryError as e:
+            codes = {code for code, _ in e.reasons}
         
-        messages.append({"role": "user", "content": user_input})
+        user_data.balance = balance
+        if balance != old_balance or changes:
+            save_user_data(user_data)
+    return old_balance, balance, changes, codes
+
+async def process_user_action(user_input, user_data, on_text=None):
+    """Обрабатывает действие пользователя через ИИ.
+    Если передан on_text, ответ читается потоком и показывается по мере генерации"""
+    try:
+        shown_balance = user_data.balance
+        messages = build_messages(user_input, user_data)
         
         # Вызываем ИИ
-        ai_response = call_ai(messages)
+        try:
+            if on_text is not None:
+                ai_response = await collect_stream(stream_ai(messages), on_text, STREAM_EDIT_INTERVAL)
+            else:
+                ai_response = await call_ai(messages, "narration", validate=lambda answer: bool(answer.strip()))
+        except AIError as e:
+            return f"❌ {e}"
         parsed = parse_ai_response(ai_response)
         
-        # Обновляем баланс
-        balance_changed = False
-        old_balance = user_data["balance"]
-        if parsed['balance'] is not None:
-            user_data["balance"] = parsed['balance']
-            change = user_data["balance"] - old_balance
-            balance_changed = True
+        # Обновляем баланс и инвентарь (блокировка передач берется в потоке работы с диском)
+        old_balance, new_balance, changes, codes = await run_io(apply_action_result, user_data, parsed, shown_balance)
+        balance_changed = parsed['balance'] is not None and "insufficient_funds" not in codes
+        change = new_balance - old_balance
+        if "insufficient_funds" in codes:
+            parsed['response'] += (f"\n\n⚠️ Пока ИИ отвечал, баланс изменился ({shown_balance}$ → {old_balance}$): "
+                                   f"денег на это действие не хватает, баланс и инвентарь не изменены.")
+        if "inventory_full" in codes:
+            parsed['response'] += f"\n\n⚠️ Не хватает места в инвентаре! Максимум {INVENTORY_SLOTS} предметов."
+        if "item_limit" in codes:
+            parsed['response'] += f"\n\n⚠️ Нельзя иметь больше {MAX_INVENTORY_ITEMS} шт. одного предмета."
         
-        # Обновляем инвентарь
-        inventory_changed = False
         inventory_updates = []
-        
-        for item, quantity_change in parsed['inventory'].items():
-            current_qty = user_data["inventory"].get(item, 0)
-            new_qty = current_qty + quantity_change
-            
-            # Проверяем лимит инвентаря
-            if new_qty > 0 and get_inventory_count(user_data["inventory"]) + quantity_change > 20:
-                parsed['response'] += f"\n\n⚠️ Не хватает места в инвентаре! Максимум 20 предметов."
-                continue
-            
-            if new_qty <= 0:
-                if item in user_data["inventory"]:
-                    del user_data["inventory"][item]
-                    inventory_updates.append(f"🗑️ {item} удален")
+        for item, (old_qty, new_qty) in changes.items():
+            if new_qty == 0:
+                inventory_updates.append(f"🗑️ {item} удален")
+            elif new_qty > old_qty:
+                inventory_updates.append(f"📦 {item}: +{new_qty - old_qty} (всего: {new_qty})")
             else:
-                user_data["inventory"][item] = new_qty
-                if quantity_change > 0:
-                    inventory_updates.append(f"📦 {item}: +{quantity_change} (всего: {new_qty})")
-                elif quantity_change < 0:
-                    inventory_updates.append(f"📦 {item}: {quantity_change} (всего: {new_qty})")
-            
-            inventory_changed = True
+                inventory_updates.append(f"📦 {item}: {new_qty - old_qty} (всего: {new_qty})")
         
-        # Сохраняем изменения
-        if balance_changed or inventory_changed:
-            user_data["history"].append({
+        # Сохраняем изменения. Журнал событий пишется в потоке работы с диском:
+        # запись может ждать слияния сегментов, которое выполняется под блокировкой журнала
+        if balance_changed or changes:
+            await run_io(record_event, user_data.user_id, {
                 "action": user_input,
                 "old_balance": old_balance,
-                "new_balance": user_data["balance"],
-                "inventory_changes": parsed['inventory'],
+                "new_balance": new_balance,
+                "inventory_changes": {item: new_qty - old_qty for item, (old_qty, new_qty) in changes.items()},
                 "timestamp": datetime.now().isoformat()
             })
         
@@ -183,12 +328,13 @@ def process_user_action(user_input, user_data):
         update_message_history(user_data, parsed['response'], "assistant")
         
         save_user_data(user_data)
+        schedule_summary(user_data, save_user_data, user_cache.pinned)
         
         # Формируем ответ
         response_text = f"📊 {parsed['response']}"
         
         if balance_changed:
-            balance_info = f"\n\n💳 БАЛАНС: {old_balance}$ → {user_data['balance']}$ "
+            balance_info = f"\n\n💳 БАЛАНС: {old_balance}$ → {new_balance}$ "
             if change > 0:
                 balance_info += f"(+{change}$) 📈"
             elif change < 0:
@@ -0,0 +1,149 @@
+import os
+import json
+import bisect
+import signal
+import asyncio
+import hashlib
+import sqlite3
+import threading
+import multiprocessing
+from telegram import Update
+from telegram.ext import Application, TypeHandler
+from config import TELEGRAM_TOKEN, SHARD_VNODES, SHARD_JOBS_DB
+
+# Номер процесса-шарда и число шардов передаются через окружение при запуске процесса:
+# от них зависят пути файлов, которые модули открывают при импорте
+SHARD_ENV = "LIFESIM_SHARD"
+SHARD_INDEX, SHARD_COUNT = (int(part) for part in os.environ.get(SHARD_ENV, "0/1").split("/"))
+
+class HashRing:
+    """Консистентное хеширование: игрок всегда попадает в один и тот же шард,
+    а при изменении числа шардов переезжает лишь часть игроков"""
+
+    def __init__(self, shards, vnodes=SHARD_VNODES):
+        points = sorted((self._hash(f"{shard}:{vnode}"), shard) for shard in range(shards) for vnode in range(vnodes))
+        self._keys = [key for key, _ in points]
+        self._shards = [shard for _, shard in points]
+
+    @staticmethod
+    def _hash(value):
+        return int.from_bytes(hashlib.blake2b(str(value).encode(), digest_size=8).digest(), "big")
+
+    def shard_for(self, user_id):
+        index = bisect.bisect(self._keys, self._hash(user_id)) % len(self._keys)
+        return self._shards[index]
+
+ring = HashRing(SHARD_COUNT)
+
+def shard_for(user_id):
+    """Шард, который обрабатывает игрока"""
+    return ring.shard_for(user_id)
+
+def is_local_user(user_id):
+    """Обрабатывается ли игрок текущим процессом"""
+    return SHARD_COUNT == 1 or ring.shard_for(user_id) == SHARD_INDEX
+
+def shard_path(path):
+    """Путь к файлу, который у каждого шарда свой (журнал передач, снимок рейтинга)"""
+    return path if SHARD_COUNT == 1 else f"{path}.{SHARD_INDEX}"
+
+class ShardJobs:
+    """Задания для других шардов в SQLite: шаги передач между игроками разных шардов.
+
+    Задание удаляется только после выполнения, вместе с постановкой следующего шага,
+    поэтому сбой процесса не теряет передачу - шаг будет выполнен повторно."""
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""
+        CREATE TABLE IF NOT EXISTS shard_jobs (
+            job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            shard INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            data TEXT NOT NULL
+        )""")
+
+    def _insert(self, shard, kind, data):
+        self.conn.execute("INSERT INTO shard_jobs (shard, kind, data) VALUES (?, ?, ?)",
+                          (shard, kind, json.dumps(data, ensure_ascii=False)))
+
+    def send(self, shard, kind, data):
+        """Ставит задание шарду"""
+        with self._lock, self.conn:
+            self._insert(shard, kind, data)
+
+    def fetch(self, shard, limit=100):
+        """Возвращает задания шарда: [(job_id, kind, data)]"""
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT job_id, kind, data FROM shard_jobs WHERE shard = ? ORDER BY job_id LIMIT ?", (shard, limit)
+            ).fetchall()
+        return [(job_id, kind, json.loads(data)) for job_id, kind, data in rows]
+
+    def complete(self, job_id, next_job=None):
+        """Удаляет выполненное задание и в той же транзакции ставит следующее (shard, kind, data)"""
+        with self._lock, self.conn:
+            self.conn.execute("DELETE FROM shard_jobs WHERE job_id = ?", (job_id,))
+            if next_job is not None:
+                self._insert(*next_job)
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
+
+shard_jobs = ShardJobs(SHARD_JOBS_DB)
+
+def start_shards(target, count):
+    """Запускает count процессов-шардов и возвращает приложение приема обновлений,
+    которое раздает обновления шардам по ID игрока"""
+    context = multiprocessing.get_context("spawn")
+    queues = [context.Queue() for _ in range(count)]
+    shards = HashRing(count)
+    processes = []
+    for index, queue in enumerate(queues):
+        os.environ[SHARD_ENV] = f"{index}/{count}"
+        process = context.Process(target=target, args=(queue,), name=f"shard-{index}")
+        process.start()
+        processes.append(process)
+    del os.environ[SHARD_ENV]
+
+    async def route(update, context):
+        user = update.effective_user
+        queues[shards.shard_for(user.id) if user else 0].put(update.to_dict())
+
+    async def stop_shards(application):
+        for queue in queues:
+            queue.put(None)
+        for process in processes:
+            await asyncio.get_running_loop().run_in_executor(None, process.join)
+
+    application = Application.builder().token(TELEGRAM_TOKEN).post_shutdown(stop_shards).build()
+    application.add_handler(TypeHandler(Update, route))
+    return application
+
+async def serve_queue(application, queue):
+    """Жизненный цикл процесса-шарда: обновления приходят из очереди, None - остановка"""
+    loop = asyncio.get_running_loop()
+    await application.initialize()
+    try:
+        if application.post_init:
+            await application.post_init(application)
+        await application.start()
+        while True:
+            data = await loop.run_in_executor(None, queue.get)
+            if data is None:
+                break
+            await application.update_queue.put(Update.de_json(data, application.bot))
+    finally:
+        if application.running:
+            await application.stop()
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+def run_shard_process(build_application, queue):
+    """Запускает процесс-шард. Остановку по Ctrl+C присылает процесс приема обновлений"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(serve_queue(build_application(), queue))
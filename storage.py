@@ -0,0 +1,154 @@
+import os
+import json
+import sqlite3
+import threading
+from player import Player, encode, decode
+from config import STORAGE_BACKEND, USERS_DIR, SQLITE_PATH
+
+class JsonStorage:
+    """Хранилище: один JSON файл на игрока"""
+
+    def __init__(self, users_dir=USERS_DIR):
+        self.users_dir = users_dir
+        os.makedirs(users_dir, exist_ok=True)
+
+    def get_user_file(self, user_id):
+        """Возвращает путь к файлу пользователя"""
+        return os.path.join(self.users_dir, f"{user_id}.json")
+
+    def load(self, user_id):
+        """Читает данные пользователя (None если игрока нет)"""
+        try:
+            with open(self.get_user_file(user_id), 'rb') as f:
+                return decode(f.read())
+        except FileNotFoundError:
+            return None
+        except ValueError:
+            print(f"Ошибка чтения файла пользователя {user_id}, создаем новый")
+            return None
+
+    def save(self, player):
+        """Атомарно записывает данные пользователя"""
+        user_file = self.get_user_file(player.user_id)
+        tmp_file = f"{user_file}.tmp"
+        with open(tmp_file, 'wb') as f:
+            f.write(encode(player))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, user_file)
+
+    def iter_users(self):
+        """Перебирает всех игроков"""
+        for filename in os.listdir(self.users_dir):
+            if filename.endswith('.json'):
+                user_data = self.load(filename[:-5])
+                if user_data is not None:
+                    yield user_data
+
+    def close(self):
+        pass
+
+class SqliteStorage:
+    """Хранилище в SQLite (WAL): игроки и инвентарь в отдельных таблицах.
+    История игроков хранится в журнале событий (eventlog.py)"""
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS players (
+        user_id INTEGER PRIMARY KEY,
+        username TEXT NOT NULL DEFAULT '',
+        first_name TEXT NOT NULL DEFAULT '',
+        balance INTEGER NOT NULL,
+        registered_date TEXT,
+        message_history TEXT NOT NULL DEFAULT '[]',
+        extra TEXT NOT NULL DEFAULT '{}'
+    );
+    CREATE INDEX IF NOT EXISTS players_balance ON players(balance DESC);
+    CREATE TABLE IF NOT EXISTS inventory (
+        user_id INTEGER NOT NULL REFERENCES players(user_id),
+        item TEXT NOT NULL,
+        quantity INTEGER NOT NULL,
+        PRIMARY KEY (user_id, item)
+    );
+    """
+
+    # Поля, у которых есть свои столбцы или таблицы; история хранится в журнале событий
+    COLUMNS = {"user_id", "username", "first_name", "balance", "registered_date",
+               "message_history", "inventory", "history"}
+
+    def __init__(self, path=SQLITE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(self.SCHEMA)
+
+    def load(self, user_id):
+        """Читает данные пользователя (None если игрока нет)"""
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT user_id, username, first_name, balance, registered_date, message_history, extra "
+                "FROM players WHERE user_id = ?", (int(user_id),)
+            ).fetchone()
+            if row is None:
+                return None
+            inventory = self.conn.execute(
+                "SELECT item, quantity FROM inventory WHERE user_id = ?", (row[0],)
+            ).fetchall()
+
+        data = json.loads(row[6])
+        data.update({
+            "user_id": row[0],
+            "username": row[1],
+            "first_name": row[2],
+            "balance": row[3],
+            "inventory": dict(inventory),
+            "message_history": json.loads(row[5]),
+            "registered_date": row[4]
+        })
+        return Player.from_dict(data)
+
+    def save(self, player):
+        """Записывает данные пользователя одной транзакцией"""
+        user_data = player.to_dict()
+        user_id = user_data["user_id"]
+        extra = {k: v for k, v in user_data.items() if k not in self.COLUMNS}
+
+        with self._lock, self.conn:
+            self.conn.execute(
+                "INSERT INTO players (user_id, username, first_name, balance, registered_date, message_history, extra) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET username = excluded.username, first_name = excluded.first_name, "
+                "balance = excluded.balance, registered_date = excluded.registered_date, "
+                "message_history = excluded.message_history, extra = excluded.extra",
+                (user_id, user_data["username"], user_data["first_name"],
+                 user_data["balance"], user_data["registered_date"],
+                 json.dumps(user_data["message_history"], ensure_ascii=False, separators=(",", ":")),
+                 json.dumps(extra, ensure_ascii=False, separators=(",", ":")))
+            )
+            self.conn.execute("DELETE FROM inventory WHERE user_id = ?", (user_id,))
+            self.conn.executemany(
+                "INSERT INTO inventory (user_id, item, quantity) VALUES (?, ?, ?)",
+                [(user_id, item, quantity) for item, quantity in user_data["inventory"].items()]
+            )
+
+    def iter_users(self):
+        """Перебирает всех игроков"""
+        with self._lock:
+            user_ids = [row[0] for row in self.conn.execute("SELECT user_id FROM players")]
+        for user_id in user_ids:
+            user_data = self.load(user_id)
+            if user_data is not None:
+                yield user_data
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
+
+def create_storage(backend=STORAGE_BACKEND):
+    """Создает хранилище по настройке STORAGE_BACKEND"""
+    if backend == "json":
+        return JsonStorage()
+    if backend == "sqlite":
+        return SqliteStorage()
+    raise ValueError(f"Неизвестное хранилище: {backend}")
@@ -0,0 +1,48 @@
+import re
+import time
+import asyncio
+
+TAG_RE = re.compile(r'<[^>]*>')
+PARTIAL_TAG_RE = re.compile(r'<[^>]*$')
+
+class ResponseExtractor:
+    """Выделяет из потока ответа ИИ видимую игроку часть: текст внутри <response>.
+    <thinking> и теги баланса/инвентаря не показываются"""
+
+    def __init__(self):
+        self.raw = ""
+
+    def feed(self, chunk):
+        """Добавляет часть ответа и возвращает видимый на данный момент текст"""
+        self.raw += chunk
+        start = self.raw.find("<response>")
+        if start == -1:
+            return ""
+        text = self.raw[start + len("<response>"):]
+        end = text.find("</response>")
+        if end != -1:
+            text = text[:end]
+        # Незакрытый тег в конце еще не дописан
+        text = PARTIAL_TAG_RE.sub("", TAG_RE.sub("", text))
+        return text.strip()
+
+async def collect_stream(chunks, on_text, interval):
+    """Читает поток ответа ИИ, вызывая on_text с видимым текстом не чаще раза в interval секунд.
+    Возвращает полный текст ответа"""
+    extractor = ResponseExtractor()
+    shown = ""
+    last_update = 0
+    update = None
+
+    async for chunk in chunks:
+        text = extractor.feed(chunk)
+        now = time.monotonic()
+        # Одновременно выполняется не больше одного обновления
+        if text and text != shown and now - last_update >= interval and (update is None or update.done()):
+            shown = text
+            last_update = now
+            update = asyncio.get_running_loop().create_task(on_text(text))
+
+    if update is not None:
+        await update
+    return extractor.raw
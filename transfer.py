@@ -1,12 +1,118 @@
+import os
 import re
+import copy
 from api import call_ai
-from prompt import load_user_data, save_user_data, get_inventory_count
+from prompt import load_user_data, find_user_data, record_event, ledger
+from player import Player
+from pending import PendingTransferStore
+from metrics import stage, stats_gauge, register, Gauge
+from sharding import shard_jobs, shard_for, is_local_user
 from datetime import datetime
+from config import (INVENTORY_SLOTS, MAX_INVENTORY_ITEMS, PENDING_TRANSFERS_DB,
+                    PENDING_TRANSFER_TTL, MAX_PENDING_PER_SENDER)
 
-# Словарь ожидающих передач
-pending_transfers = {}
+# Ожидающие подтверждения передачи
+pending_transfers = PendingTransferStore(PENDING_TRANSFERS_DB, PENDING_TRANSFER_TTL, MAX_PENDING_PER_SENDER)
 
-def parse_transfer_command(text):
+# Счетчики локального разбора команд передачи
+parse_stats = {"local_hits": 0, "ai_fallbacks": 0}
+stats_gauge("lifesim_transfer_parse", "Разбор команд передачи: локально или через ИИ", parse_stats, "result")
+register(Gauge("lifesim_pending_transfers", "Передачи, ожидающие подтверждения", lambda: [({}, len(pending_transfers))]))
+
+MESSAGE_RE = re.compile(r'[\s,]*(?:\bс\s+)?\b(?:сообщением|сообщение|текстом|запиской|подписью)\b\s*[:\-]?\s*(.*)$', re.I | re.S)
+RECEIVER_RE = re.compile(r'\b(?:игроку|игрок|пользователю|юзеру|получателю|id|айди|ид)\b\s*[:#№]?\s*(\d{3,})', re.I)
+MONEY_RE = re.compile(r'(\d+)\s*(?:\$|(?:долларов|доллара|доллар|баксов|бакса|бакс)\b)|\$\s*(\d+)', re.I)
+TOKEN_RE = re.compile(r'\d+|[^\W\d_]+|,')
+
+# Слова, которые не являются названиями предметов и разделяют их
+FILLER_WORDS = {
+    "хочу", "я", "передать", "передаю", "передам", "передай", "кинуть", "кину", "кидаю", "кинь",
+    "отдать", "отдам", "отдаю", "отдай", "дать", "дам", "даю", "дай", "мой", "моя", "мое", "моё",
+    "мою", "мои", "свой", "свою", "свои", "свое", "своё", "ему", "ей", "вот", "его", "её", "ее",
+    "так", "же", "также", "еще", "ещё", "а", "и", "пожалуйста", ","
+}
+QUANTITY_WORDS = {"шт", "штук", "штуки", "штука", "x", "х"}
+
+def same_stem(a, b):
+    """Сравнивает слова без учета окончаний: 'воду' и 'вода'"""
+    return a == b or len(os.path.commonprefix([a, b])) >= max(3, len(a) - 2, len(b) - 2)
+
+def match_inventory_item(name, inventory):
+    """Ищет предмет в инвентаре по названию с учетом окончаний"""
+    if name in inventory:
+        return name
+    words = name.split()
+    candidates = []
+    for item in inventory:
+        item_words = item.lower().split()
+        if len(item_words) == len(words) and all(same_stem(a, b) for a, b in zip(item_words, words)):
+            candidates.append(item)
+    return candidates[0] if len(candidates) == 1 else None
+
+def parse_item_chunk(words, inventory):
+    """Разбирает один предмет: 'яблоко', '2 яблока', 'яблоко x2'"""
+    words = [w for w in words if w not in QUANTITY_WORDS]
+    quantity = 1
+    if words and words[0].isdigit():
+        quantity = int(words.pop(0))
+    elif words and words[-1].isdigit():
+        quantity = int(words.pop())
+    if not words or any(w.isdigit() for w in words) or quantity <= 0:
+        return None
+    item = match_inventory_item(" ".join(words), inventory)
+    return (item, quantity) if item else None
+
+def parse_transfer_local(text, inventory):
+    """Быстрый разбор команды передачи без ИИ.
+    Возвращает None, если команда не похожа на стандартную форму"""
+    message = ""
+    message_match = MESSAGE_RE.search(text)
+    if message_match:
+        message = message_match.group(1).strip().strip('"\'«»')
+        text = text[:message_match.start()]
+    
+    receivers = RECEIVER_RE.findall(text)
+    if len(receivers) != 1:
+        return None
+    receiver_id = int(receivers[0])
+    text = RECEIVER_RE.sub(" , ", text)
+    
+    amounts = MONEY_RE.findall(text)
+    if len(amounts) > 1:
+        return None
+    money = int(amounts[0][0] or amounts[0][1]) if amounts else 0
+    text = MONEY_RE.sub(" , ", text)
+    
+    # Все остальные слова должны быть предметами из инвентаря
+    items = {}
+    chunk = []
+    for token in TOKEN_RE.findall(text.lower()) + [","]:
+        if token not in FILLER_WORDS:
+            chunk.append(token)
+            continue
+        if chunk:
+            parsed = parse_item_chunk(chunk, inventory or {})
+            if parsed is None:
+                return None
+            items[parsed[0]] = items.get(parsed[0], 0) + parsed[1]
+            chunk = []
+    
+    if money <= 0 and not items:
+        return None
+    return money, items, receiver_id, message
+
+async def parse_transfer_command(text, inventory=None):
+    """Парсит команду передачи: сначала локально, при неуверенности через ИИ"""
+    with stage("parse"):
+        result = parse_transfer_local(text, inventory)
+    if result is not None:
+        parse_stats["local_hits"] += 1
+        return result
+    
+    parse_stats["ai_fallbacks"] += 1
+    return await parse_transfer_with_ai(text)
+
+async def parse_transfer_with_ai(text):
     """Парсит команду передачи через ИИ"""
     system_prompt = """
 Ты парсер команд передачи в игре. Игроки могут передавать деньги и предметы друг другу.
@@ -48,8 +154,8 @@ def parse_transfer_command(text):
         {"role": "user", "content": text}
     ]
     
-    from api import call_ai
-    response = call_ai(messages)
+    # Быстрая модель; ответ без нужных тегов не годится, и запрос уходит запасной модели
+    response = await call_ai(messages, "parse", validate=lambda answer: "<receiver_id=" in answer)
     
     # Парсим ответ
     money_match = re.search(r'<money=(\d+)>', response)
@@ -72,57 +178,65 @@ def parse_transfer_command(text):
     
     return money, items, receiver_id, message
 
-def validate_transfer(sender_id, receiver_id, money, items):
-    """Проверяет возможность передачи через ИИ"""
-    sender_data = load_user_data(sender_id)
-    receiver_data = load_user_data(receiver_id)
-    
-    system_prompt = f"""
-Проверь возможность передачи между игроками:
-
-ОТПРАВИТЕЛЬ (ID: {sender_id}):
-- Баланс: {sender_data['balance']}$
-- Инвентарь: {sender_data['inventory']}
-
-ПОЛУЧАТЕЛЬ (ID: {receiver_id}):
-- Баланс: {receiver_data['balance']}$
-- Инвентарь: {receiver_data['inventory']}
-- Количество предметов: {get_inventory_count(receiver_data['inventory'])}/20
-
-ПЕРЕДАЧА:
-- Деньги: {money}$
-- Предметы: {items}
-
-Максимум предметов у получателя: 20
+def outgoing(items):
+    """Изменения инвентаря отправителя: предметы со знаком минус"""
+    return {item: -quantity for item, quantity in items.items()}
 
-ФОРМАТ ОТВЕТА:
-<valid=true/false>
-<reason=ПРИЧИНА>
-
-Если передача возможна - valid=true, иначе valid=false с причиной.
-"""
+def check_transfer(sender_data, receiver_data, money, items):
+    """Проверяет передачу по правилам игры.
+    Возвращает список причин отказа (code, текст); пустой список - передача возможна"""
+    reasons = []
     
-    messages = [{"role": "system", "content": system_prompt}]
+    if sender_data.user_id == receiver_data.user_id:
+        reasons.append(("self_transfer", "Нельзя передать самому себе"))
+    if money < 0 or any(quantity <= 0 for quantity in items.values()):
+        reasons.append(("invalid_amount", "Количество должно быть положительным"))
+    if money <= 0 and not items:
+        reasons.append(("empty_transfer", "Нечего передавать"))
     
-    from api import call_ai
-    response = call_ai(messages)
+    items = {item: quantity for item, quantity in items.items() if quantity > 0}
     
-    valid_match = re.search(r'<valid=(true|false)>', response)
-    reason_match = re.search(r'<reason=([^>]+)>', response)
+    # Отправитель
+    if money > sender_data.balance:
+        reasons.append(("insufficient_funds", f"Недостаточно денег: {sender_data.balance}$ из {money}$"))
+    for code, item in sender_data.inventory.check(outgoing(items), slots=None, max_items=None):
+        if code == "missing_item":
+            reasons.append((code, f"У вас нет предмета «{item}»"))
+        else:
+            reasons.append((code, f"Недостаточно «{item}»: {sender_data.inventory.get(item)} из {items[item]} шт."))
     
-    is_valid = valid_match.group(1) == "true" if valid_match else False
-    reason = reason_match.group(1) if reason_match else "Неизвестная ошибка"
+    # Получатель
+    for code, item in receiver_data.inventory.check(items):
+        if code == "inventory_full":
+            reasons.append(("receiver_inventory_full",
+                            f"У получателя не хватает места: {receiver_data.inventory.total}/{INVENTORY_SLOTS}, "
+                            f"нужно еще {sum(items.values())}"))
+        else:
+            reasons.append((code, f"У получателя будет больше {MAX_INVENTORY_ITEMS} шт. «{item}»"))
+    
+    return reasons
+
+def validate_transfer(sender_id, receiver_id, money, items):
+    """Проверяет возможность передачи"""
+    sender_data = find_user_data(sender_id)
+    receiver_data = find_user_data(receiver_id)
+    if sender_data is None or receiver_data is None:
+        return False, "Игрок не найден"
     
-    return is_valid, reason
+    with stage("validate"):
+        reasons = check_transfer(sender_data, receiver_data, money, items)
+    if reasons:
+        return False, "\n❌ ".join(text for _, text in reasons)
+    return True, ""
 
 def create_transfer(sender_id, receiver_id, money, items, message):
     """Создает запрос на передачу"""
-    # Проверяем получателя
-    receiver_data = load_user_data(receiver_id)
-    if "user_id" not in receiver_data:
+    # Проверяем получателя (поиск не регистрирует несуществующего игрока)
+    receiver_data = find_user_data(receiver_id)
+    if receiver_data is None:
         return False, "❌ Игрок не найден"
     
-    # Проверяем через ИИ
+    # Проверяем по правилам игры
     is_valid, reason = validate_transfer(sender_id, receiver_id, money, items)
     if not is_valid:
         return False, f"❌ {reason}"
@@ -132,7 +246,7 @@ def create_transfer(sender_id, receiver_id, money, items, message):
     
     transfer_data = {
         "sender_id": sender_id,
-        "sender_name": load_user_data(sender_id).get("first_name", "Неизвестный"),
+        "sender_name": find_user_data(sender_id).first_name or "Неизвестный",
         "receiver_id": receiver_id,
         "money": money,
         "items": items,
@@ -140,54 +254,149 @@ def create_transfer(sender_id, receiver_id, money, items, message):
         "timestamp": datetime.now().isoformat()
     }
     
-    pending_transfers[transfer_id] = transfer_data
+    if not pending_transfers.add(transfer_id, transfer_data):
+        return False, f"❌ У вас уже {MAX_PENDING_PER_SENDER} неподтвержденных передач. Дождитесь ответа получателей."
     return True, transfer_id
 
-def execute_transfer(transfer_id):
-    """Выполняет подтвержденную передачу"""
-    if transfer_id not in pending_transfers:
-        return False
-    
-    transfer = pending_transfers[transfer_id]
-    sender_data = load_user_data(transfer["sender_id"])
-    receiver_data = load_user_data(transfer["receiver_id"])
-    
-    # Передаем деньги
-    sender_data["balance"] -= transfer["money"]
-    receiver_data["balance"] += transfer["money"]
-    
-    # Передаем предметы
-    for item, quantity in transfer["items"].items():
-        sender_data["inventory"][item] = sender_data["inventory"].get(item, 0) - quantity
-        if sender_data["inventory"][item] <= 0:
-            del sender_data["inventory"][item]
-        
-        receiver_data["inventory"][item] = receiver_data["inventory"].get(item, 0) + quantity
+def recover_transfers():
+    """Применяет передачи, прерванные сбоем"""
+    return ledger.replay()
+
+def debit_sender(sender_data, transfer):
+    """Списывает у отправителя деньги и предметы передачи. Возвращает событие для истории"""
+    sender_data.balance -= transfer["money"]
+    sender_data.inventory.apply(outgoing(transfer["items"]), slots=None, max_items=None)
     
-    # Сохраняем историю
-    sender_data["history"].append({
+    return {
         "type": "transfer_sent",
         "to": transfer["receiver_id"],
         "money": transfer["money"],
         "items": transfer["items"],
         "message": transfer["message"],
         "timestamp": datetime.now().isoformat()
-    })
+    }
+
+def credit_receiver(receiver_data, transfer):
+    """Зачисляет получателю деньги и предметы передачи. Возвращает событие для истории"""
+    receiver_data.balance += transfer["money"]
+    receiver_data.inventory.apply(transfer["items"])
     
-    receiver_data["history"].append({
-        "type": "transfer_received", 
+    return {
+        "type": "transfer_received",
         "from": transfer["sender_id"],
         "money": transfer["money"],
         "items": transfer["items"],
         "message": transfer["message"],
         "timestamp": datetime.now().isoformat()
-    })
+    }
+
+def refund_sender(sender_data, transfer):
+    """Возвращает отправителю списанное, если получатель не смог принять передачу.
+    Возвращает событие для истории"""
+    sender_data.balance += transfer["money"]
+    # Возвращаем свое: лимиты инвентаря не применяются
+    sender_data.inventory.apply(transfer["items"], slots=None, max_items=None)
+    
+    return {
+        "type": "transfer_refunded",
+        "to": transfer["receiver_id"],
+        "money": transfer["money"],
+        "items": transfer["items"],
+        "timestamp": datetime.now().isoformat()
+    }
+
+TRANSFER_NOT_FOUND = "❌ Передача не найдена"
+
+def execute_transfer(transfer_id):
+    """Выполняет подтвержденную передачу. Возвращает (успех, причина отказа);
+    успех None - передача выполняется через шард отправителя. Любой отказ, кроме
+    TRANSFER_NOT_FOUND, означает, что передача снята и отправителя нужно уведомить"""
+    # Забираем передачу сразу, чтобы ее нельзя было принять дважды
+    transfer = pending_transfers.pop(transfer_id, None)
+    if transfer is None:
+        return False, TRANSFER_NOT_FOUND
+    
+    if not is_local_user(transfer["sender_id"]):
+        # Отправителя обрабатывает другой процесс: сначала списание у него, затем зачисление здесь
+        shard_jobs.send(shard_for(transfer["sender_id"]), "debit", dict(transfer, transfer_id=transfer_id))
+        return None, ""
     
-    save_user_data(sender_data)
-    save_user_data(receiver_data)
+    with ledger.lock_users(transfer["sender_id"], transfer["receiver_id"]):
+        sender_data = copy.deepcopy(load_user_data(transfer["sender_id"]))
+        receiver_data = copy.deepcopy(load_user_data(transfer["receiver_id"]))
+        
+        # Повторно проверяем: с момента запроса баланс мог измениться
+        with stage("validate"):
+            reasons = check_transfer(sender_data, receiver_data, transfer["money"], transfer["items"])
+        if reasons:
+            return False, "❌ " + "\n❌ ".join(text for _, text in reasons)
+        
+        sent = debit_sender(sender_data, transfer)
+        received = credit_receiver(receiver_data, transfer)
+        
+        # Обе стороны записываются атомарно через журнал; при ошибке записи
+        # живые данные игроков не меняются
+        try:
+            ledger.commit(transfer_id, [sender_data.to_dict(), receiver_data.to_dict()])
+        except Exception as e:
+            print(f"Ошибка записи передачи {transfer_id}: {e}")
+            return False, "❌ Не удалось сохранить передачу, попробуйте позже"
     
-    del pending_transfers[transfer_id]
-    return True
+    record_event(transfer["sender_id"], sent)
+    record_event(transfer["receiver_id"], received)
+    return True, ""
+
+# Шаги передачи между шардами: debit у отправителя -> credit у получателя,
+# при отказе получателя - refund у отправителя. Каждый шаг отмечается в данных
+# игрока, поэтому повтор шага после сбоя ничего не меняет.
+TRANSFER_STEPS = {"debit": debit_sender, "credit": credit_receiver, "refund": refund_sender}
+MAX_STEP_MARKS = 50
+
+def check_step(kind, user_data, transfer):
+    """Проверяет шаг по правилам игры для одной стороны: вторая подставляется так,
+    чтобы ее условия выполнялись (ее проверяет свой шаг)"""
+    money, items = transfer["money"], transfer["items"]
+    if kind == "debit":
+        return check_transfer(user_data, Player(transfer["receiver_id"]), money, items)
+    if kind == "credit":
+        sender = Player(transfer["sender_id"], balance=money, inventory=dict(items))
+        return check_transfer(sender, user_data, money, items)
+    return []
+
+def apply_transfer_step(job_id, kind, transfer):
+    """Выполняет шаг передачи, присланный другим шардом.
+    Возвращает (итог, причина): "done" - передача выполнена, "failed" - отменена, None - продолжается"""
+    step_id = f"{transfer['transfer_id']}:{kind}"
+    user_id = transfer["receiver_id"] if kind == "credit" else transfer["sender_id"]
+    
+    with ledger.lock_users(user_id):
+        user_data = copy.deepcopy(load_user_data(user_id))
+        reasons = []
+        if step_id not in user_data.transfer_steps:
+            with stage("validate"):
+                reasons = check_step(kind, user_data, transfer)
+            if not reasons:
+                event = TRANSFER_STEPS[kind](user_data, transfer)
+                user_data.transfer_steps.append(step_id)
+                del user_data.transfer_steps[:-MAX_STEP_MARKS]
+                ledger.commit(step_id, [user_data.to_dict()])
+                record_event(user_id, event)
+    
+    reason = "❌ " + "\n❌ ".join(text for _, text in reasons) if reasons else ""
+    if kind == "debit" and not reasons:
+        shard_jobs.complete(job_id, (shard_for(transfer["receiver_id"]), "credit", transfer))
+        return None, ""
+    if kind == "credit" and reasons:
+        shard_jobs.complete(job_id, (shard_for(transfer["sender_id"]), "refund", transfer))
+        return "failed", reason
+    shard_jobs.complete(job_id)
+    if kind == "refund":
+        return None, ""
+    return ("failed", reason) if reasons else ("done", "")
+
+def expire_transfers():
+    """Удаляет передачи, которые получатель не подтвердил вовремя"""
+    return pending_transfers.expire()
 
 def get_transfer_info(transfer_id):
     """Возвращает информацию о передаче"""
@@ -0,0 +1,162 @@
+import hmac
+import json
+import signal
+import asyncio
+from collections import deque
+from telegram import Update
+from metrics import register, Counter
+from config import (WEBHOOK_URL, WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_SECRET,
+                    WEBHOOK_DEDUPE_SIZE, WEBHOOK_MAX_BODY)
+
+SECRET_HEADER = "x-telegram-bot-api-secret-token"
+
+WEBHOOK_UPDATES = register(Counter(
+    "lifesim_webhook_updates_total", "Входящие запросы вебхука по результату"))
+
+STATUS_TEXT = {
+    200: "OK", 400: "Bad Request", 403: "Forbidden", 404: "Not Found",
+    405: "Method Not Allowed", 413: "Payload Too Large"
+}
+
+class UpdateDeduplicator:
+    """Помнит последние max_size update_id: Telegram повторяет доставку,
+    если не получил ответ вовремя, и одно обновление может прийти дважды"""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._seen = set()
+        self._order = deque()
+
+    def add(self, update_id):
+        """Запоминает ID. Возвращает False, если он уже встречался"""
+        if update_id in self._seen:
+            return False
+        self._seen.add(update_id)
+        self._order.append(update_id)
+        if len(self._order) > self.max_size:
+            self._seen.discard(self._order.popleft())
+        return True
+
+class WebhookServer:
+    """HTTP сервер для приема обновлений Telegram.
+
+    Запрос проверяется по секретному токену, обновление кладется в очередь
+    приложения и сразу подтверждается ответом 200 - обработка идет отдельно.
+    Соединения держатся открытыми (keep-alive), как их использует Telegram."""
+
+    def __init__(self, application, path, secret, dedupe_size=10000, max_body=1 << 20):
+        if not secret:
+            raise ValueError("Для вебхука нужен секретный токен (WEBHOOK_SECRET в config.py)")
+        self.application = application
+        self.path = path
+        self.secret = secret.encode()
+        self.max_body = max_body
+        self.dedupe = UpdateDeduplicator(dedupe_size)
+        self._server = None
+        self._connections = set()
+
+    async def start(self, host, port):
+        self._server = await asyncio.start_server(self._handle_connection, host, port)
+        return self._server
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            # Telegram держит соединения открытыми - закрываем их сами
+            for writer in list(self._connections):
+                writer.close()
+            await self._server.wait_closed()
+
+    def accept(self, method, path, headers, body):
+        """Обрабатывает запрос и возвращает код ответа"""
+        if path.split("?")[0] != self.path:
+            return 404
+        if method != "POST":
+            return 405
+        if not hmac.compare_digest(headers.get(SECRET_HEADER, "").encode(), self.secret):
+            WEBHOOK_UPDATES.inc(result="forbidden")
+            return 403
+        try:
+            data = json.loads(body)
+            update_id = data["update_id"]
+        except (ValueError, TypeError, KeyError):
+            WEBHOOK_UPDATES.inc(result="invalid")
+            return 400
+
+        # Повтор уже принятого обновления тоже подтверждаем, иначе Telegram продолжит слать его
+        if not self.dedupe.add(update_id):
+            WEBHOOK_UPDATES.inc(result="duplicate")
+            return 200
+        self.application.update_queue.put_nowait(Update.de_json(data, self.application.bot))
+        WEBHOOK_UPDATES.inc(result="accepted")
+        return 200
+
+    async def _handle_connection(self, reader, writer):
+        self._connections.add(writer)
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+
+                parts = request_line.decode("latin-1").split()
+                length = int(headers.get("content-length") or 0)
+                if len(parts) < 2 or length > self.max_body:
+                    await self._respond(writer, 400 if len(parts) < 2 else 413, close=True)
+                    break
+                body = await reader.readexactly(length) if length else b""
+
+                status = self.accept(parts[0], parts[1], headers, body)
+                close = headers.get("connection", "").lower() == "close"
+                await self._respond(writer, status, close)
+                if close:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            self._connections.discard(writer)
+            writer.close()
+
+    @staticmethod
+    async def _respond(writer, status, close=False):
+        writer.write(f"HTTP/1.1 {status} {STATUS_TEXT[status]}\r\nContent-Length: 0\r\n"
+                     f"Connection: {'close' if close else 'keep-alive'}\r\n\r\n".encode())
+        await writer.drain()
+
+async def serve_webhook(application):
+    """Жизненный цикл бота в режиме вебхука: то же, что run_polling, но обновления
+    принимает собственный HTTP сервер за обратным прокси"""
+    server = WebhookServer(application, WEBHOOK_PATH, WEBHOOK_SECRET, WEBHOOK_DEDUPE_SIZE, WEBHOOK_MAX_BODY)
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    await application.initialize()
+    try:
+        if application.post_init:
+            await application.post_init(application)
+        await server.start(WEBHOOK_HOST, WEBHOOK_PORT)
+        await application.bot.set_webhook(WEBHOOK_URL, secret_token=WEBHOOK_SECRET,
+                                          allowed_updates=Update.ALL_TYPES)
+        await application.start()
+        print(f"Вебхук принимает обновления на {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+        await stop.wait()
+    finally:
+        await server.close()
+        if application.running:
+            await application.stop()
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+def run_webhook(application):
+    """Запускает бота в режиме вебхука"""
+    asyncio.run(serve_webhook(application))